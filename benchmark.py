@@ -0,0 +1,249 @@
+import argparse
+import json
+import platform
+import statistics
+import sys
+import timeit
+from types import SimpleNamespace
+
+from bot_helpers import (MenuPages,
+                         get_main_menu_markup,
+                         get_nearest_pizzeria,
+                         show_cart)
+from moltin_handlers import MoltinClient
+from stub_servers import make_pizzerias, make_prices, make_products
+
+
+MENU_SIZES = (10, 100, 1000, 10_000)
+PIZZERIAS_SIZES = (10, 1000, 10_000, 100_000)
+CART_SIZES = (10, 100, 1000)
+PRICEBOOK_SIZES = (100, 10_000, 100_000)
+
+USER_COORS = (55.751244, 37.618423)
+
+
+def get_args():
+    parser = argparse.ArgumentParser(
+        description="Микробенчмарки горячих функций бота без обращений к сети"
+    )
+    parser.add_argument("-k", "--filter",
+                        default="",
+                        help="Run only the cases whose name contains "
+                             "this text")
+    parser.add_argument("-o", "--output",
+                        default="benchmark_results.json",
+                        help="Save the results to this JSON file")
+    parser.add_argument("-b", "--baseline",
+                        help="Compare the results with this earlier "
+                             "results file")
+    parser.add_argument("-t", "--threshold",
+                        type=float,
+                        default=1.3,
+                        help="Slowdown of the median against the baseline "
+                             "that counts as a regression")
+    parser.add_argument("-r", "--repeat",
+                        type=int,
+                        default=7,
+                        help="Number of timing rounds per case")
+    parser.add_argument("--confirm",
+                        type=int,
+                        default=2,
+                        help="How many times a regressed case is measured "
+                             "again; it fails only if every run is slower")
+    return parser.parse_args()
+
+
+def make_catalog_client(products):
+    '''Moltin client stand-in that serves a fixed catalog'''
+    return SimpleNamespace(
+        get_all_products=lambda: products,
+        products_cache=SimpleNamespace(get_versioned=lambda: (products, 1))
+    )
+
+
+def make_pricebook_client(prices):
+    moltin_client = MoltinClient("benchmark", "benchmark")
+    moltin_client.iter_prices = lambda page_size=100: iter(prices)
+    return moltin_client
+
+
+def make_cart_screen(cart_size):
+    '''Update, context and cart of a user pressing a button under
+    the menu message'''
+    products = make_products(cart_size)
+    prices = make_prices(products)
+    cart_items = [
+        {"product_id": product["id"],
+         "item_id": f"item-{num}",
+         "name": product["attributes"]["name"],
+         "unit_price": price["attributes"]["currencies"]["RUB"]["amount"],
+         "quantity": num % 5 + 1}
+        for num, (product, price) in enumerate(zip(products, prices))
+    ]
+    cart_mirror = SimpleNamespace(get_items=lambda cart_id: cart_items)
+    message = SimpleNamespace(chat_id=1, message_id=1,
+                              text="Пожалуйста, выберите товар:")
+    update = SimpleNamespace(effective_user=SimpleNamespace(id=1),
+                             callback_query=SimpleNamespace(message=message))
+    tg_bot = SimpleNamespace(edit_message_text=lambda **kwargs: None)
+    context = SimpleNamespace(bot=tg_bot, user_data={}, bot_data={})
+    return update, context, cart_mirror
+
+
+def get_cases():
+    '''Yields (name, setup, func): setup prepares data outside
+    the timing, func is the timed call'''
+    for size in MENU_SIZES:
+        def setup(size=size):
+            return MenuPages(make_catalog_client(make_products(size)))
+
+        yield (f"menu_markup_build[{size}]", setup,
+               lambda menu_pages: menu_pages._build_pages(
+                   menu_pages.moltin_client.get_all_products()
+               ))
+        yield (f"menu_markup_page[{size}]", setup,
+               lambda menu_pages: get_main_menu_markup(menu_pages, 1))
+
+    for size in PIZZERIAS_SIZES:
+        def setup(size=size):
+            pizzerias = make_pizzerias(size)
+            moltin_client = MoltinClient("benchmark", "benchmark")
+            moltin_client.get_pizzerias_details = lambda: pizzerias
+            moltin_client.pizzerias_cache.get()
+            return moltin_client
+
+        yield (f"nearest_pizzeria_index[{size}]", setup,
+               lambda moltin_client: moltin_client.pizzerias_cache.refresh())
+        yield (f"nearest_pizzeria_query[{size}]", setup,
+               lambda moltin_client: get_nearest_pizzeria(moltin_client,
+                                                          USER_COORS))
+
+    for size in CART_SIZES:
+        yield (f"show_cart[{size}]",
+               lambda size=size: make_cart_screen(size),
+               lambda cart_screen: show_cart(*cart_screen))
+
+    for size in PRICEBOOK_SIZES:
+        def setup(size=size):
+            moltin_client = make_pricebook_client(
+                make_prices(make_products(size))
+            )
+            moltin_client.prices_cache.refresh()
+            return moltin_client
+
+        yield (f"price_index_build[{size}]", setup,
+               lambda moltin_client: moltin_client.fetch_price_index())
+        yield (f"find_product_price[{size}]", setup,
+               lambda moltin_client, size=size: moltin_client.find_product_price(
+                   f"sku-{size // 2}"
+               ))
+
+
+def run_reference():
+    '''Fixed pure-Python work timed between the rounds of every case,
+    so a machine that got slower as a whole is not taken for a
+    regression'''
+    return sorted(str(num) for num in range(1000))
+
+
+reference_timer = timeit.Timer(run_reference)
+
+
+def run_case(setup, func, repeat):
+    '''Returns seconds per call: best and median of the rounds, and the
+    median of the reference work measured in between'''
+    data = setup()
+    timer = timeit.Timer(lambda: func(data))
+    number, _ = timer.autorange()
+    reference_number, _ = reference_timer.autorange()
+    rounds, reference_rounds = [], []
+    for _ in range(repeat):
+        rounds.append(timer.timeit(number) / number)
+        reference_rounds.append(
+            reference_timer.timeit(reference_number) / reference_number
+        )
+    return {"best_s": min(rounds), "median_s": statistics.median(rounds),
+            "reference_s": statistics.median(reference_rounds),
+            "loops": number}
+
+
+def format_duration(seconds):
+    for unit, scale in (("с", 1), ("мс", 1e-3), ("мкс", 1e-6)):
+        if seconds >= scale:
+            return f"{seconds / scale:.2f} {unit}"
+    return f"{seconds / 1e-9:.0f} нс"
+
+
+def get_slowdown(case, baseline_case):
+    '''Slowdown of the median relative to the reference work'''
+    slowdown = case["median_s"] / baseline_case["median_s"]
+    if "reference_s" in case and "reference_s" in baseline_case:
+        slowdown /= case["reference_s"] / baseline_case["reference_s"]
+    return slowdown
+
+
+def find_regressions(results, baseline, threshold):
+    return [name for name, case in results["cases"].items()
+            if name in baseline["cases"]
+            and get_slowdown(case, baseline["cases"][name]) > threshold]
+
+
+def confirm_regressions(results, baseline, args):
+    '''Measures regressed cases again and keeps the fastest run, so a
+    case fails only when the slowdown repeats'''
+    cases = {name: (setup, func) for name, setup, func in get_cases()}
+    for _ in range(args.confirm):
+        for name in find_regressions(results, baseline, args.threshold):
+            case = run_case(*cases[name], args.repeat)
+            if case["median_s"] < results["cases"][name]["median_s"]:
+                results["cases"][name] = case
+
+
+def compare_with_baseline(results, baseline, threshold):
+    '''Prints the slowdown of every case's median; returns names of
+    regressed ones'''
+    regressions = find_regressions(results, baseline, threshold)
+    print(f"\nСравнение медиан с {baseline['created_by']}:")
+    for name, case in results["cases"].items():
+        baseline_case = baseline["cases"].get(name)
+        if not baseline_case:
+            continue
+        ratio = get_slowdown(case, baseline_case)
+        mark = "  ⚠ медленнее" if name in regressions else ""
+        print(f"{name:<36}{format_duration(baseline_case['median_s']):>14}"
+              f"{format_duration(case['median_s']):>14}{ratio:>8.2f}x{mark}")
+    return regressions
+
+
+def main():
+    args = get_args()
+    results = {
+        "created_by": f"Python {platform.python_version()} "
+                      f"на {platform.machine()}",
+        "cases": {},
+    }
+    for name, setup, func in get_cases():
+        if args.filter not in name:
+            continue
+        case = run_case(setup, func, args.repeat)
+        results["cases"][name] = case
+        print(f"{name:<36}{format_duration(case['best_s']):>14}"
+              f"{format_duration(case['median_s']):>14}")
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as file:
+            baseline = json.load(file)
+        confirm_regressions(results, baseline, args)
+
+    with open(args.output, "w", encoding="utf-8") as file:
+        json.dump(results, file, ensure_ascii=False, indent=2)
+
+    if baseline:
+        regressions = compare_with_baseline(results, baseline, args.threshold)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,13 @@
 import logging
-import os
 import pathlib
 from textwrap import dedent
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum, auto
+from functools import partial
 from time import sleep
 
 from environs import Env
+from marshmallow.validate import URL, OneOf
 from telegram import (Update,
                       InlineKeyboardButton,
                       InlineKeyboardMarkup,
@@ -15,42 +17,37 @@ from telegram.ext import (CallbackContext,
                           CallbackQueryHandler,
                           CommandHandler,
                           ConversationHandler,
+                          Defaults,
                           Filters,
                           MessageHandler,
                           Updater, PreCheckoutQueryHandler)
+from telegram.utils.request import Request
 
 
-from bot_helpers import (delete_previous_message,
-                         download_photo,
-                         get_main_menu_markup,
+from bot_helpers import (MenuPages,
+                         fetch_product_card,
+                         send_product_photo,
                          show_cart,
                          fetch_coordinates,
                          get_nearest_pizzeria,
                          send_message_after_delivery_time, show_next_page,
-                         show_previous_page)
-from moltin_handlers import (generate_moltin_token,
-                             get_product_data,
-                             add_product_to_cart,
-                             delete_product_from_cart,
-                             find_product_price)
-from upload_data_to_ep import create_entry
+                         show_previous_page,
+                         show_text_screen)
+from moltin_handlers import MoltinClient
+from cart_mirror import CartMirror
+from delayed_jobs import DelayedJobStore, run_due_jobs
+from geocoding_cache import GeocodingCache
+from media_cache import ProductImageStore, TelegramFileIdCache
+from metrics import measure, metrics, start_metrics_server
+from send_scheduler import Priority, ScheduledBot, SendScheduler, send_priority
+from sessions import evict_idle_sessions, get_memory_report, get_session
+from sqlite_persistence import SQLitePersistence
+from tg_logs import TelegramLogsHandler
 
 
 logger = logging.getLogger("TGBotLogger")
 
 
-class TelegramLogsHandler(logging.Handler):
-
-    def __init__(self, tg_bot, chat_id):
-        super().__init__()
-        self.chat_id = chat_id
-        self.tg_bot = tg_bot
-
-    def emit(self, record):
-        log_entry = self.format(record)
-        self.tg_bot.send_message(chat_id=self.chat_id, text=log_entry)
-
-
 class State(Enum):
     SHOW_MENU = auto()
     HANDLE_MENU = auto()
@@ -61,9 +58,10 @@ class State(Enum):
     HANDLE_PAYMENT = auto()
 
 
+@measure("handler")
 def start(update: Update, context: CallbackContext):
     user = update.effective_user
-    context.user_data["current_page"] = 0
+    get_session(context).current_page = 0
     reply_markup = InlineKeyboardMarkup(
         [[InlineKeyboardButton("Да, показать меню",
                                callback_data="show_menu")]]
@@ -75,22 +73,21 @@ def start(update: Update, context: CallbackContext):
     return State.SHOW_MENU
 
 
+@measure("handler")
 def show_menu(update: Update, context: CallbackContext):
-    user_query = update.callback_query
-    delete_previous_message(context, update)
-    menu_markup = get_main_menu_markup(context.bot_data["moltin_token"],
-                                       context.user_data["current_page"])
-    context.bot.send_message(
-        chat_id=user_query.message.chat_id,
-        text="Пожалуйста, выберите товар:",
-        reply_markup=menu_markup
+    session = get_session(context)
+    session.current_page, menu_markup = context.bot_data["menu_pages"].get_page(
+        session.current_page
     )
+    show_text_screen(context, update, "Пожалуйста, выберите товар:",
+                     menu_markup)
     return State.HANDLE_MENU
 
 
+@measure("handler")
 def handle_menu(update: Update, context: CallbackContext):
     user_query = update.callback_query
-    moltin_token = context.bot_data["moltin_token"]
+    cart_mirror = context.bot_data["cart_mirror"]
     if user_query["data"] == "next_page":
         show_next_page(update, context)
         return State.HANDLE_MENU
@@ -98,93 +95,90 @@ def handle_menu(update: Update, context: CallbackContext):
         show_previous_page(update, context)
         return State.HANDLE_MENU
     if user_query["data"] == "cart":
-        show_cart(update, context, moltin_token)
+        show_cart(update, context, cart_mirror)
         return State.HANDLE_CART
     if user_query["data"] == "back":
         show_menu(update, context)
         return State.SHOW_MENU
 
-    context.user_data["product_id"] = user_query.data
-    delete_previous_message(context, update)
-
-    product_data = get_product_data(moltin_token, user_query)
-    product_img_id = product_data["relationships"]["main_image"]["data"]["id"]
-    download_photo(moltin_token, product_img_id)
-
-    for filename in os.listdir("images"):
-        if product_img_id != os.path.splitext(filename)[0]:
-            continue
-        with open(f"images/{filename}", "rb") as image:
-            reply_markup = InlineKeyboardMarkup(
-                [
-                    [InlineKeyboardButton("Добавить в корзину", callback_data=user_query.data)],
-                    [InlineKeyboardButton("🛒 КОРЗИНА", callback_data="cart")],
-                    [InlineKeyboardButton("Назад", callback_data="back")]
-                ]
-            )
-            product_attrs = product_data["attributes"]
-            product_price = find_product_price(moltin_token, product_attrs["sku"])
-            caption_text = f"""
-                    {product_attrs['name']}
-            
-                    Цена: {product_price} руб.
-
-                    {product_attrs['description']}
-                """
-            context.bot.send_photo(chat_id=user_query.message.chat_id,
-                                   photo=image,
-                                   caption=dedent(caption_text)[:1024],
-                                   reply_markup=reply_markup)
-            return State.HANDLE_DESCRIPTION
-
 
+    product_data, product_price, product_img_id, photo = fetch_product_card(
+        context, user_query.data
+    )
+    reply_markup = InlineKeyboardMarkup(
+        [
+            [InlineKeyboardButton("Добавить в корзину", callback_data=user_query.data)],
+            [InlineKeyboardButton("🛒 КОРЗИНА", callback_data="cart")],
+            [InlineKeyboardButton("Назад", callback_data="back")]
+        ]
+    )
+    product_attrs = product_data["attributes"]
+    caption_text = f"""
+            {product_attrs['name']}
+    
+            Цена: {product_price} руб.
+
+            {product_attrs['description']}
+        """
+    send_product_photo(context,
+                       update,
+                       img_id=product_img_id,
+                       photo=photo,
+                       caption=dedent(caption_text)[:1024],
+                       reply_markup=reply_markup)
+    return State.HANDLE_DESCRIPTION
+
+
+@measure("handler")
 def handle_description(update: Update, context: CallbackContext):
     user_query = update.callback_query
-    moltin_token = context.bot_data["moltin_token"]
+    cart_mirror = context.bot_data["cart_mirror"]
 
     if user_query["data"] == "back":
         show_menu(update, context)
         return State.HANDLE_MENU
     if user_query["data"] == "cart":
-        show_cart(update, context, moltin_token)
+        show_cart(update, context, cart_mirror)
         return State.HANDLE_CART
 
-    cart_response = add_product_to_cart(token=moltin_token,
-                                        cart_id=update.effective_user.id,
-                                        product_id=user_query["data"])
-    if "errors" in cart_response:
-        update.callback_query.answer(
-            text="Произошла ошибка. Попробуйте снова"
-        )
-        return State.HANDLE_DESCRIPTION
+    cart_quantity = cart_mirror.add(cart_id=update.effective_user.id,
+                                    product_id=user_query["data"])
     update.callback_query.answer(
-        text=f"Пицца добавлена в корзину",
-        show_alert=True
+        text=f"Пицца добавлена в корзину. В корзине: {cart_quantity} шт."
     )
 
 
+@measure("handler")
 def handle_cart(update: Update, context: CallbackContext):
     user_query = update.callback_query
-    moltin_token = context.bot_data["moltin_token"]
+    cart_mirror = context.bot_data["cart_mirror"]
 
     if user_query["data"] == "get_menu":
         show_menu(update, context)
         return State.HANDLE_MENU
 
     elif user_query["data"] == "check_out":
+        if not cart_mirror.reconcile(update.effective_user.id):
+            update.callback_query.answer(
+                text="Корзина изменилась, проверьте заказ ещё раз",
+                show_alert=True
+            )
+            show_cart(update, context, cart_mirror)
+            return State.HANDLE_CART
         context.bot.send_message(chat_id=user_query.message.chat_id,
                                  text="Укажите адрес или координаты")
         return State.WAITING_LOCATION
 
-    delete_product_from_cart(token=moltin_token,
-                             cart_id=update.effective_user.id,
-                             product_id=user_query["data"])
-    show_cart(update, context, moltin_token)
+    cart_mirror.remove(cart_id=update.effective_user.id,
+                       product_id=user_query["data"])
+    show_cart(update, context, cart_mirror)
     return State.HANDLE_CART
 
 
+@measure("handler")
 def handle_location(update: Update, context: CallbackContext):
-    moltin_token = context.bot_data["moltin_token"]
+    moltin_client = context.bot_data["moltin_client"]
+    session = get_session(context)
     if update.edited_message:
         if update.edited_message.location:
             users_location = update.edited_message.location
@@ -199,9 +193,9 @@ def handle_location(update: Update, context: CallbackContext):
                            users_location.longitude)
         elif update.message.text:
             users_address = update.message.text
-            current_pos = fetch_coordinates(
-                context.bot_data["yandex_api_key"],
-                users_address)
+            current_pos = context.bot_data["geocoding_cache"].fetch_coordinates(
+                users_address
+            )
         else:
             current_pos = None
 
@@ -216,10 +210,12 @@ def handle_location(update: Update, context: CallbackContext):
                 [InlineKeyboardButton("Самовывоз", callback_data="self_pickup")]
             ]
         )
-        nearest_pizzeria = get_nearest_pizzeria(moltin_token, current_pos)
+        nearest_pizzeria = get_nearest_pizzeria(moltin_client, current_pos)
         distance_to_nearest_pizzeria = nearest_pizzeria["distance_to_user"]
-        context.user_data["nearest_pizzeria"] = nearest_pizzeria
-        context.user_data["customer_coors"] = current_pos
+        session.pizzeria_address = nearest_pizzeria["address"]
+        session.carrier_id = int(nearest_pizzeria["carrier_id"])
+        session.customer_coors = tuple(map(float, current_pos))
+        session.delivery_price = 0
         if distance_to_nearest_pizzeria <= 0.5:
             reply_msg = f"""
                     Может, заберёте пиццу из нашей пиццерии неподалёку? 
@@ -244,7 +240,7 @@ def handle_location(update: Update, context: CallbackContext):
                 text=dedent(reply_msg),
                 reply_markup=reply_markup
             )
-            context.user_data["delivery_price"] = delivery_price
+            session.delivery_price = delivery_price
         elif distance_to_nearest_pizzeria <= 20:
             delivery_price = 300
             reply_msg = f"""
@@ -256,7 +252,7 @@ def handle_location(update: Update, context: CallbackContext):
                      f"{delivery_price} руб. Оформляем заказ?",
                 reply_markup=reply_markup
             )
-            context.user_data["delivery_price"] = delivery_price
+            session.delivery_price = delivery_price
         else:
             reply_msg = f"""
                 Простите, но так далеко мы пиццу не доставим. 
@@ -267,20 +263,21 @@ def handle_location(update: Update, context: CallbackContext):
         return State.HANDLE_DELIVERY_METHOD
 
 
+@measure("handler")
 def handle_delivery_method(update: Update, context: CallbackContext):
     user_query = update.callback_query
-    nearest_pizzeria = context.user_data["nearest_pizzeria"]
+    session = get_session(context)
 
     if user_query["data"] == "delivery":
-        sum_in_rub = context.user_data["total"] + context.user_data["delivery_price"]
-        context.user_data["delivery_method"] = "delivery"
+        sum_in_rub = session.total + session.delivery_price
+        session.delivery_method = "delivery"
 
     elif user_query["data"] == "self_pickup":
         context.bot.send_message(chat_id=user_query.message.chat_id,
                                  text=f"Ваша пицца будет готова по адресу: "
-                                      f"{nearest_pizzeria['address']}")
-        sum_in_rub = context.user_data["total"]
-        context.user_data["delivery_method"] = "self_pickup"
+                                      f"{session.pizzeria_address}")
+        sum_in_rub = session.total
+        session.delivery_method = "self_pickup"
 
     chat_id = update.effective_chat.id
     title = "Оплата заказа"
@@ -296,6 +293,7 @@ def handle_delivery_method(update: Update, context: CallbackContext):
                              start_parameter, currency, prices)
 
 
+@measure("handler")
 def precheckout_callback(update, context):
     query = update.pre_checkout_query
     if query.invoice_payload != "PizzaPayment":
@@ -311,69 +309,102 @@ def precheckout_callback(update, context):
         )
 
 
+@measure("handler")
 def successful_payment_callback(update, context):
-    moltin_token = context.bot_data["moltin_token"]
-    nearest_pizzeria = context.user_data["nearest_pizzeria"]
+    moltin_client = context.bot_data["moltin_client"]
+    session = get_session(context)
     update.message.reply_text("Отлично! Мы уже готовим вашу пиццу!")
 
-    if context.user_data["delivery_method"] == "delivery":
-        users_lat, users_lon = context.user_data["customer_coors"]
-        create_entry(
-            moltin_token,
+    if session.delivery_method == "delivery":
+        users_lat, users_lon = session.customer_coors
+        moltin_client.create_entry(
             "customer-address",
             [("customer-id", update.message.chat.id),
              ("lat", users_lat),
              ("lon", users_lon)]
         )
-        carrier_id = int(nearest_pizzeria["carrier_id"])
-        context.bot.send_location(chat_id=carrier_id,
-                                  latitude=users_lat,
-                                  longitude=users_lon)
+        with send_priority(Priority.CARRIER):
+            context.bot.send_location(chat_id=session.carrier_id,
+                                      latitude=users_lat,
+                                      longitude=users_lon)
         delivery_time_in_sec = 3600
-        context.job_queue.run_once(send_message_after_delivery_time,
-                                   delivery_time_in_sec,
-                                   context=update.message.chat.id)
+        context.bot_data["delayed_jobs"].schedule(
+            "after_delivery", delivery_time_in_sec,
+            chat_id=update.message.chat.id
+        )
         return ConversationHandler.END
 
 
+@measure("handler")
 def finish(update: Update, context: CallbackContext):
     update.message.reply_text("Будем рады видеть вас снова 😊")
     return ConversationHandler.END
 
 
-def regenerate_token(context: CallbackContext):
-    moltin_token, _ = generate_moltin_token(
-        context.bot_data["moltin_client_id"],
-        context.bot_data["moltin_secret_key"]
+def show_memory_report(update: Update, context: CallbackContext):
+    update.message.reply_text(
+        get_memory_report(context.dispatcher,
+                          context.bot_data["conversation_handlers"])
     )
-    context.bot_data["moltin_token"] = moltin_token
 
 
-def main():
-    env = Env()
-    env.read_env()
+def reload_moltin_catalog(moltin_client):
+    '''Reads the catalog, the pricebook and the pizzerias from Moltin
+    again. Returns the number of products'''
+    moltin_client.invalidate_products_cache()
+    moltin_client.invalidate_prices_cache()
+    moltin_client.invalidate_pizzerias_cache()
+    products_num = len(moltin_client.get_all_products())
+    moltin_client.prices_cache.get()
+    moltin_client.pizzerias_cache.get()
+    return products_num
 
-    logging.basicConfig(
-        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-        level=logging.INFO)
 
-    tg_bot_token = env.str("TG_BOT_TOKEN")
-    tg_bot_merchant_token = env.str("TG_BOT_MERCHANT_TOKEN")
-    moltin_client_id = env.str("MOLTIN_CLIENT_ID")
-    moltin_secret_key = env.str("MOLTIN_SECRET_KEY")
-    tg_admin_chat_id = env.str("TG_ADMIN_CHAT_ID")
-    yandex_api_key = env.str("YANDEX_API_KEY")
+def reload_catalog(update: Update, context: CallbackContext):
+    products_num = reload_moltin_catalog(context.bot_data["moltin_client"])
+    update.message.reply_text(f"Каталог загружен заново, товаров: "
+                              f"{products_num}")
 
-    bot = Bot(token=tg_bot_token)
-    logger.setLevel(level=logging.INFO)
-    logger.addHandler(TelegramLogsHandler(bot, tg_admin_chat_id))
-    logger.info("Бот запущен")
 
-    pathlib.Path("images/").mkdir(exist_ok=True)
+def send_metrics_report(context: CallbackContext):
+    with send_priority(Priority.BACKGROUND):
+        context.bot.send_message(context.job.context,
+                                 text=metrics.get_report())
+
+
+def run_delayed_jobs(context: CallbackContext):
+    job_runners = {
+        "after_delivery": partial(send_message_after_delivery_time,
+                                  context.bot),
+    }
+    run_due_jobs(context.bot_data["delayed_jobs"], job_runners,
+                 time_budget=context.job.context)
 
-    updater = Updater(tg_bot_token)
-    dispatcher = updater.dispatcher
 
+def prefetch_product_images(context: CallbackContext):
+    moltin_client = context.bot_data["moltin_client"]
+    image_store = context.bot_data["image_store"]
+    all_products, catalog_version = moltin_client.products_cache.get_versioned()
+    if catalog_version == image_store.prefetched_version:
+        return
+    img_ids = [
+        product["relationships"]["main_image"]["data"]["id"]
+        for product in all_products
+        if (product.get("relationships", {}).get("main_image") or {}).get("data")
+    ]
+    with ThreadPoolExecutor(max_workers=context.job.context) as executor:
+        failed_num = image_store.prefetch(moltin_client, img_ids, executor)
+    if failed_num:
+        logger.warning(f"Не удалось загрузить фото товаров: {failed_num} шт.")
+        return
+    image_store.prefetched_version = catalog_version
+
+
+def refresh_prices(context: CallbackContext):
+    context.bot_data["moltin_client"].prices_cache.refresh()
+
+
+def add_handlers(dispatcher, conversation_timeout, admin_chat_id):
     conv_handler = ConversationHandler(
         entry_points=[CommandHandler("start", start)],
         states={
@@ -399,30 +430,175 @@ def main():
                 CommandHandler("start", start)
             ],
         },
-        fallbacks=[CommandHandler("finish", finish)]
+        fallbacks=[CommandHandler("finish", finish)],
+        name="pizza_order",
+        persistent=True,
+        conversation_timeout=conversation_timeout
     )
-    dispatcher.bot_data["moltin_client_id"] = moltin_client_id
-    dispatcher.bot_data["moltin_secret_key"] = moltin_secret_key
-    dispatcher.bot_data["yandex_api_key"] = yandex_api_key
-    dispatcher.bot_data["merchant_token"] = tg_bot_merchant_token
-
-    moltin_token, exp_period = generate_moltin_token(moltin_client_id,
-                                                     moltin_secret_key)
-    dispatcher.bot_data["moltin_token"] = moltin_token
-    updater.job_queue.run_repeating(regenerate_token, interval=exp_period)
-
+    dispatcher.bot_data["conversation_handlers"] = [conv_handler]
     dispatcher.add_handler(conv_handler)
+    dispatcher.add_handler(
+        CommandHandler("memory",
+                       show_memory_report,
+                       filters=Filters.chat(int(admin_chat_id)))
+    )
+    dispatcher.add_handler(
+        CommandHandler("reload_catalog",
+                       reload_catalog,
+                       filters=Filters.chat(int(admin_chat_id)))
+    )
     dispatcher.add_handler(PreCheckoutQueryHandler(precheckout_callback))
     dispatcher.add_handler(MessageHandler(Filters.successful_payment,
                                           successful_payment_callback))
 
+
+def main():
+    env = Env()
+    env.read_env()
+
+    logging.basicConfig(
+        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+        level=logging.INFO)
+
+    tg_bot_token = env.str("TG_BOT_TOKEN")
+    tg_bot_merchant_token = env.str("TG_BOT_MERCHANT_TOKEN")
+    moltin_client_id = env.str("MOLTIN_CLIENT_ID")
+    moltin_secret_key = env.str("MOLTIN_SECRET_KEY")
+    tg_admin_chat_id = env.str("TG_ADMIN_CHAT_ID")
+    yandex_api_key = env.str("YANDEX_API_KEY")
+    products_cache_ttl = env.int("PRODUCTS_CACHE_TTL", 300)
+    prices_cache_ttl = env.int("PRICES_CACHE_TTL", 300)
+    pizzerias_cache_ttl = env.int("PIZZERIAS_CACHE_TTL", 300)
+    moltin_pool_size = env.int("MOLTIN_POOL_SIZE", 10)
+    moltin_timeout = env.float("MOLTIN_TIMEOUT", 10)
+    product_card_workers = env.int("PRODUCT_CARD_WORKERS", 8)
+    menu_page_size = env.int("MENU_PAGE_SIZE", 5)
+    cart_add_debounce = env.float("CART_ADD_DEBOUNCE", 1.0)
+    persistence_path = env.str("PERSISTENCE_PATH", "bot_state.sqlite3")
+    persistence_flush_interval = env.float("PERSISTENCE_FLUSH_INTERVAL", 5)
+    session_idle_timeout = env.int("SESSION_IDLE_TIMEOUT", 3600)
+    geocoding_cache_path = env.str("GEOCODING_CACHE_PATH",
+                                   "geocoding_cache.sqlite3")
+    updates_mode = env.str("TG_UPDATES_MODE", "polling",
+                           validate=OneOf(["polling", "webhook"]))
+    tg_workers = env.int("TG_WORKERS", 4)
+    tg_run_async = env.bool("TG_RUN_ASYNC", False)
+    webhook_listen = env.str("WEBHOOK_LISTEN", "127.0.0.1")
+    webhook_port = env.int("WEBHOOK_PORT", 8443)
+    webhook_path = env.str("WEBHOOK_PATH", tg_bot_token)
+    webhook_url = None
+    if updates_mode == "webhook":
+        # without it PTB registers https://<listen>:<port>/<path>, which
+        # Telegram rejects, and start_webhook then hangs
+        webhook_url = env.str("WEBHOOK_URL",
+                              validate=URL(schemes={"https"}))
+    metrics_port = env.int("METRICS_PORT", 8097)
+    metrics_report_interval = env.int("METRICS_REPORT_INTERVAL", 3600)
+    tg_global_rate = env.float("TG_GLOBAL_RATE", 30)
+    tg_chat_rate = env.float("TG_CHAT_RATE", 1)
+    delayed_jobs_path = env.str("DELAYED_JOBS_PATH", "delayed_jobs.sqlite3")
+    delayed_jobs_interval = env.int("DELAYED_JOBS_INTERVAL", 10)
+    image_prefetch_workers = env.int("IMAGE_PREFETCH_WORKERS", 8)
+
+    bot = Bot(token=tg_bot_token)
+    logger.setLevel(level=logging.INFO)
+    logger.addHandler(TelegramLogsHandler(bot, tg_admin_chat_id))
+    logger.info("Бот запущен")
+
+    pathlib.Path("images/").mkdir(exist_ok=True)
+
+    persistence = SQLitePersistence(persistence_path,
+                                    flush_interval=persistence_flush_interval,
+                                    store_bot_data=False)
+    scheduled_bot = ScheduledBot(
+        tg_bot_token,
+        SendScheduler(global_rate=tg_global_rate, chat_rate=tg_chat_rate),
+        defaults=Defaults(run_async=tg_run_async),
+        request=Request(con_pool_size=tg_workers + 4)
+    )
+    updater = Updater(bot=scheduled_bot,
+                      workers=tg_workers,
+                      persistence=persistence)
+    dispatcher = updater.dispatcher
+
+    dispatcher.bot_data["yandex_api_key"] = yandex_api_key
+    dispatcher.bot_data["merchant_token"] = tg_bot_merchant_token
+    dispatcher.bot_data["file_ids_cache"] = TelegramFileIdCache(
+        "images/telegram_file_ids.json"
+    )
+    dispatcher.bot_data["image_store"] = ProductImageStore("images/")
+    dispatcher.bot_data["geocoding_cache"] = GeocodingCache(
+        geocoding_cache_path,
+        partial(fetch_coordinates, yandex_api_key)
+    )
+
+    moltin_client = MoltinClient(moltin_client_id,
+                                 moltin_secret_key,
+                                 pool_size=moltin_pool_size,
+                                 timeout=moltin_timeout)
+    moltin_client.products_cache.ttl = products_cache_ttl
+    moltin_client.prices_cache.ttl = prices_cache_ttl
+    moltin_client.pizzerias_cache.ttl = pizzerias_cache_ttl
+    moltin_client.get_token()
+    dispatcher.bot_data["moltin_client"] = moltin_client
+    dispatcher.bot_data["menu_pages"] = MenuPages(moltin_client,
+                                                  menu_page_size)
+    dispatcher.bot_data["executor"] = ThreadPoolExecutor(
+        max_workers=product_card_workers
+    )
+    dispatcher.bot_data["cart_mirror"] = CartMirror(
+        moltin_client,
+        dispatcher.bot_data["executor"],
+        add_debounce=cart_add_debounce
+    )
+    updater.job_queue.run_repeating(refresh_prices,
+                                    interval=prices_cache_ttl,
+                                    first=0)
+    updater.job_queue.run_repeating(prefetch_product_images,
+                                    interval=products_cache_ttl,
+                                    first=0,
+                                    context=image_prefetch_workers)
+
+    dispatcher.bot_data["delayed_jobs"] = DelayedJobStore(delayed_jobs_path)
+    updater.job_queue.run_repeating(run_delayed_jobs,
+                                    interval=delayed_jobs_interval,
+                                    first=0,
+                                    context=delayed_jobs_interval / 2)
+    updater.job_queue.run_repeating(evict_idle_sessions,
+                                    interval=session_idle_timeout,
+                                    context=session_idle_timeout)
+    updater.job_queue.run_repeating(send_metrics_report,
+                                    interval=metrics_report_interval,
+                                    context=tg_admin_chat_id)
+    try:
+        start_metrics_server(metrics_port, post_actions={
+            "/reload_catalog": partial(reload_moltin_catalog, moltin_client),
+        })
+    except OSError as err:
+        logger.error(f"Не удалось запустить сервер метрик на порту "
+                     f"{metrics_port}: {err}")
+
+    add_handlers(dispatcher, session_idle_timeout, tg_admin_chat_id)
+
     while True:
         try:
-            updater.start_polling()
+            if updates_mode == "webhook":
+                updater.start_webhook(listen=webhook_listen,
+                                      port=webhook_port,
+                                      url_path=webhook_path,
+                                      webhook_url=webhook_url)
+            else:
+                updater.start_polling()
             updater.idle()
+            break
         except Exception as err:
             logger.exception(f"⚠ Ошибка бота:\n\n {err}")
             sleep(60)
+    dispatcher.bot_data["cart_mirror"].close()
+    dispatcher.bot_data["executor"].shutdown(wait=True)
+    dispatcher.update_persistence()
+    persistence.close()
+    logger.info("Бот остановлен")
 
 
 if __name__ == "__main__":
@@ -1,117 +1,241 @@
-import os
 import pathlib
+import threading
+from concurrent.futures import FIRST_EXCEPTION, wait
 from textwrap import dedent
-from urllib.parse import urlsplit, unquote
 
-from geopy import distance
 from more_itertools import chunked
 import requests
-from telegram import InlineKeyboardButton, InlineKeyboardMarkup
-
-from moltin_handlers import get_cart_items, get_all_products
-
-
-def get_extension(url):
-    split_url = urlsplit(unquote(url))
-    file_extension = os.path.splitext(split_url.path)[1]
-    return file_extension
-
+from telegram import (InlineKeyboardButton,
+                      InlineKeyboardMarkup,
+                      InputMediaPhoto)
+from telegram.error import BadRequest
+
+from metrics import measure
+from send_scheduler import Priority, send_priority
+from sessions import get_session
+
+
+def get_product_photo(context, img_id):
+    '''Returns Telegram file_id of the photo or path to its optimized copy'''
+    file_id = context.bot_data["file_ids_cache"].get(img_id)
+    if file_id:
+        return file_id
+    return context.bot_data["image_store"].fetch(
+        context.bot_data["moltin_client"], img_id
+    )
 
-def download_photo(token, img_id):
-    endpoint = f"https://api.moltin.com/v2/files/{img_id}"
-    headers = {
-        "Authorization": f"Bearer {token}",
-        "Content-Type": "application/json",
-    }
-    response = requests.get(endpoint, headers=headers)
-    response.raise_for_status()
 
-    img_url = response.json()["data"]["link"]["href"]
-    ext = get_extension(img_url)
-    product_img = pathlib.Path(f"images/{img_id}{ext}")
-    if not product_img.exists():
-        img_response = requests.get(img_url)
-        img_response.raise_for_status()
-        with open(product_img, "wb") as file:
-            file.write(img_response.content)
-
-
-def get_main_menu_markup(token, current_page):
-    all_products = get_all_products(token)
-    products_per_page = 5
-    products_groups = list(chunked(all_products, products_per_page))
-    pages_num = len(products_groups)
-    current_page_products = products_groups[current_page]
-    buttons = [[InlineKeyboardButton(f'🍕 {product["attributes"]["name"]}',
-                                     callback_data=product["id"])]
-               for product in current_page_products]
-
-    if current_page > 0:
-        buttons.insert(0, [InlineKeyboardButton("<<<", callback_data="previous_page")])
-    if current_page < pages_num-1:
-        buttons.append([InlineKeyboardButton(">>>", callback_data="next_page")])
-    buttons.append([InlineKeyboardButton("🛒 КОРЗИНА", callback_data="cart")])
-    return InlineKeyboardMarkup(buttons)
-
-
-def show_cart(update, context, headers):
-    user_query = update.callback_query
-    context.bot.delete_message(chat_id=user_query.message.chat_id,
-                               message_id=user_query.message.message_id)
-    cart_items = get_cart_items(headers, update.effective_user.id)
-    total_price = cart_items["meta"]["display_price"]["with_tax"]["formatted"]
+@measure("outbound_call")
+def fetch_product_card(context, product_id):
+    '''Loads product data, price and photo concurrently.
+
+    SKU and image id are taken from the cached catalog when possible, so
+    all three calls start at once; the first failed call is re-raised.
+    '''
+    moltin_client = context.bot_data["moltin_client"]
+    executor = context.bot_data["executor"]
+    product_future = executor.submit(moltin_client.get_product_data,
+                                     product_id)
+    product = moltin_client.find_product(product_id)
+    if not product or "main_image" not in product.get("relationships", {}):
+        product = product_future.result()
+    product_img_id = product["relationships"]["main_image"]["data"]["id"]
+    price_future = executor.submit(moltin_client.find_product_price,
+                                   product["attributes"]["sku"])
+    photo_future = executor.submit(get_product_photo, context, product_img_id)
+
+    futures = [product_future, price_future, photo_future]
+    done, _ = wait(futures, return_when=FIRST_EXCEPTION)
+    for future in done:
+        if future.exception():
+            raise future.exception()
+    product_data, product_price, photo = [future.result() for future in futures]
+    return product_data, product_price, product_img_id, photo
+
+
+def send_product_photo(context, update, img_id, photo, caption,
+                       reply_markup):
+    if not isinstance(photo, pathlib.Path):
+        try:
+            show_photo_screen(context, update, photo, caption, reply_markup)
+            return
+        except BadRequest:
+            # file_id of another bot token or one Telegram no longer has
+            context.bot_data["file_ids_cache"].delete(img_id)
+            photo = context.bot_data["image_store"].fetch(
+                context.bot_data["moltin_client"], img_id
+            )
+
+    with open(photo, "rb") as image:
+        message = show_photo_screen(context, update, image, caption,
+                                    reply_markup)
+    context.bot_data["file_ids_cache"].set(img_id, message.photo[-1].file_id)
+
+
+@measure("outbound_call")
+def show_photo_screen(context, update, photo, caption, reply_markup):
+    '''Replaces the photo of the pressed message in place, or deletes
+    the message and sends a new one when it has no photo to replace'''
+    message = update.callback_query.message
+    if message.photo:
+        try:
+            return context.bot.edit_message_media(
+                chat_id=message.chat_id,
+                message_id=message.message_id,
+                media=InputMediaPhoto(photo, caption=caption),
+                reply_markup=reply_markup
+            )
+        except BadRequest:
+            if hasattr(photo, "seek"):
+                photo.seek(0)
+    delete_previous_message(context, update)
+    return context.bot.send_photo(chat_id=message.chat_id,
+                                  photo=photo,
+                                  caption=caption,
+                                  reply_markup=reply_markup)
+
+
+@measure("outbound_call")
+def show_text_screen(context, update, text, reply_markup):
+    '''Edits the pressed message in place, or deletes it and sends a new
+    one when a photo card has to turn into a text message'''
+    message = update.callback_query.message
+    if message.text is not None:
+        try:
+            if message.text == text:
+                context.bot.edit_message_reply_markup(
+                    chat_id=message.chat_id,
+                    message_id=message.message_id,
+                    reply_markup=reply_markup
+                )
+            else:
+                context.bot.edit_message_text(
+                    text=text,
+                    chat_id=message.chat_id,
+                    message_id=message.message_id,
+                    reply_markup=reply_markup
+                )
+            return
+        except BadRequest as err:
+            if "message is not modified" in err.message.lower():
+                return
+    delete_previous_message(context, update)
+    context.bot.send_message(chat_id=message.chat_id,
+                             text=text,
+                             reply_markup=reply_markup)
+
+
+class MenuPages:
+    '''Keeps ready-made keyboards of all menu pages for the current
+    catalog version and rebuilds them once the catalog changes'''
+
+    def __init__(self, moltin_client, products_per_page=5):
+        self.moltin_client = moltin_client
+        self.products_per_page = products_per_page
+        self._version = None
+        self._pages = []
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._pages)
+
+    def get_page(self, page_num):
+        '''Returns (page_num, markup) with page_num clamped to the pages
+        of the current catalog'''
+        all_products, version = self.moltin_client.products_cache.get_versioned()
+        if version != self._version:
+            with self._lock:
+                if version != self._version:
+                    self._pages = self._build_pages(all_products)
+                    self._version = version
+        pages = self._pages
+        page_num = min(max(page_num, 0), len(pages) - 1)
+        return page_num, pages[page_num]
+
+    def get_markup(self, page_num):
+        return self.get_page(page_num)[1]
+
+    def _build_pages(self, all_products):
+        products_groups = list(chunked(all_products, self.products_per_page))
+        pages_num = len(products_groups)
+        pages = []
+        for page_num, page_products in enumerate(products_groups or [[]]):
+            buttons = [[InlineKeyboardButton(f'🍕 {product["attributes"]["name"]}',
+                                             callback_data=product["id"])]
+                       for product in page_products]
+            if page_num > 0:
+                buttons.insert(0, [InlineKeyboardButton("<<<", callback_data="previous_page")])
+            if page_num < pages_num-1:
+                buttons.append([InlineKeyboardButton(">>>", callback_data="next_page")])
+            buttons.append([InlineKeyboardButton("🛒 КОРЗИНА", callback_data="cart")])
+            pages.append(InlineKeyboardMarkup(buttons))
+        return pages
+
+
+def get_main_menu_markup(menu_pages, current_page):
+    return menu_pages.get_markup(current_page)
+
+
+def format_price(amount):
+    return f"{amount:,}".replace(",", ".")
+
+
+def show_cart(update, context, cart_mirror):
+    cart_items = cart_mirror.get_items(update.effective_user.id)
+    total_price = 0
     text = ""
     buttons = []
-    for item in cart_items["data"]:
-        text += (f'🍕 {item["name"]}\n'
-                 f'{item["meta"]["display_price"]["with_tax"]["unit"]["formatted"]} руб/шт.\n'
-                 f'{item["quantity"]} шт. на '
-                 f'{item["meta"]["display_price"]["with_tax"]["value"]["formatted"]} руб.\n\n')
+    for item in cart_items:
+        if item["unit_price"] is None:
+            # price is not known yet; checkout reloads the cart first
+            text += (f'🍕 {item["name"]}\n'
+                     f'цена уточняется\n'
+                     f'{item["quantity"]} шт.\n\n')
+        else:
+            item_price = item["unit_price"] * item["quantity"]
+            total_price += item_price
+            text += (f'🍕 {item["name"]}\n'
+                     f'{format_price(item["unit_price"])} руб/шт.\n'
+                     f'{item["quantity"]} шт. на '
+                     f'{format_price(item_price)} руб.\n\n')
         buttons.append(
             [InlineKeyboardButton(f"{item['name']} ✖️",
-                                  callback_data=item["id"])]
+                                  callback_data=item["product_id"])]
         )
-    text += f"ИТОГО: {total_price} руб."
+    text += f"ИТОГО: {format_price(total_price)} руб."
     buttons.append([InlineKeyboardButton("📄 В МЕНЮ", callback_data="get_menu")])
     buttons.append([InlineKeyboardButton("🍕 ОФОРМИТЬ ЗАКАЗ",
                                          callback_data="check_out")])
-    context.bot.send_message(chat_id=update.effective_user.id,
-                             text=text,
-                             reply_markup=InlineKeyboardMarkup(buttons))
-    context.user_data["total"] = int(total_price.replace(".", ""))
+    show_text_screen(context, update, text, InlineKeyboardMarkup(buttons))
+    get_session(context).total = total_price
 
 
 def show_previous_page(update, context):
-    context.user_data["current_page"] -= 1
-    menu_markup = get_main_menu_markup(context.bot_data["moltin_token"],
-                                       context.user_data["current_page"])
-    delete_previous_message(context, update)
-    context.bot.send_message(
-        chat_id=update.callback_query.message.chat_id,
-        text="Пожалуйста, выберите товар:",
-        reply_markup=menu_markup
+    session = get_session(context)
+    session.current_page, menu_markup = context.bot_data["menu_pages"].get_page(
+        session.current_page - 1
     )
+    show_text_screen(context, update, "Пожалуйста, выберите товар:",
+                     menu_markup)
 
 
 def show_next_page(update, context):
-    context.user_data["current_page"] += 1
-    menu_markup = get_main_menu_markup(context.bot_data["moltin_token"],
-                                       context.user_data["current_page"])
-    delete_previous_message(context, update)
-    context.bot.send_message(
-        chat_id=update.callback_query.message.chat_id,
-        text="Пожалуйста, выберите товар:",
-        reply_markup=menu_markup
+    session = get_session(context)
+    session.current_page, menu_markup = context.bot_data["menu_pages"].get_page(
+        session.current_page + 1
     )
+    show_text_screen(context, update, "Пожалуйста, выберите товар:",
+                     menu_markup)
 
 
-def fetch_coordinates(apikey, address):
-    base_url = "https://geocode-maps.yandex.ru/1.x"
+@measure("outbound_call")
+def fetch_coordinates(apikey, address,
+                      base_url="https://geocode-maps.yandex.ru/1.x"):
     response = requests.get(base_url, params={
         "geocode": address,
         "apikey": apikey,
         "format": "json",
-    })
+    }, timeout=10)
     response.raise_for_status()
     found_places = response.json()["response"]["GeoObjectCollection"]["featureMember"]
 
@@ -123,49 +247,28 @@ def fetch_coordinates(apikey, address):
     return lat, lon
 
 
-def get_distance(from_coors, to_coors):
-    distance_in_km = distance.distance(from_coors, to_coors).km
-    return round(distance_in_km, 2)
-
-
-def get_pizzerias_details(token):
-    flow_slug = "pizzeria"
-    endpoint = f"https://api.moltin.com/v2/flows/{flow_slug}/entries"
-    headers = {"Authorization": f"Bearer {token}"}
-    response = requests.get(endpoint, headers=headers)
-    response.raise_for_status()
-    return response.json()["data"]
-
-
-def get_distances(distances):
-    return distances["distance_to_user"]
-
-
-def get_nearest_pizzeria(token, users_coors):
-    all_pizzerias = get_pizzerias_details(token)
-    distances_to_user = []
-    for pizzeria in all_pizzerias:
-        pizzeria_coors = (pizzeria["lat"], pizzeria["lon"])
-        pizzeria_data = {"address": pizzeria["address"],
-                         "carrier_id": pizzeria["carrier-id"],
-                         "distance_to_user": get_distance(pizzeria_coors,
-                                                          users_coors)
-                         }
-        distances_to_user.append(pizzeria_data)
-    return min(distances_to_user, key=get_distances)
+@measure("outbound_call")
+def get_nearest_pizzeria(moltin_client, users_coors):
+    return moltin_client.pizzerias_cache.get().nearest(users_coors)[0]
 
 
-def send_message_after_delivery_time(context):
+def send_message_after_delivery_time(tg_bot, chat_id):
     msg = """
         Приятного аппетита!
         
         *что делать если пицца не пришла*
     """
-    context.bot.send_message(context.job.context, text=dedent(msg))
+    with send_priority(Priority.BACKGROUND):
+        tg_bot.send_message(chat_id, text=dedent(msg))
 
 
+@measure("outbound_call")
 def delete_previous_message(context, update):
-    context.bot.delete_message(
-        chat_id=update.callback_query.message.chat_id,
-        message_id=update.callback_query.message.message_id
-    )
+    try:
+        context.bot.delete_message(
+            chat_id=update.callback_query.message.chat_id,
+            message_id=update.callback_query.message.message_id
+        )
+    except BadRequest:
+        # already deleted, or too old to be deleted
+        pass
@@ -0,0 +1,242 @@
+import logging
+import threading
+from collections import deque
+from functools import partial
+
+import requests
+
+
+logger = logging.getLogger("TGBotLogger")
+
+
+class LocalCart:
+
+    def __init__(self, cart_id):
+        self.cart_id = cart_id
+        self.items = {}
+        self.is_loaded = False
+        self.pending_ops = deque()
+        self.pending_adds = {}
+        self.flush_timers = {}
+        self.is_syncing = False
+        self.synced = threading.Event()
+        self.synced.set()
+        self.lock = threading.Lock()
+
+
+class CartMirror:
+    '''Local copy of users' Moltin carts.
+
+    Adds and removals are applied to the local copy at once and pushed to
+    Moltin in the background, one operation at a time per cart. The copy
+    is loaded from Moltin on first use and after a failed push, and is
+    compared with Moltin on checkout. Carts of idle users are dropped
+    with forget() and loaded again on their next visit.
+
+    Taps on the same product within add_debounce seconds are merged into
+    one Moltin request with the summed quantity. close() pushes the adds
+    still waiting for their window to end, so call it before shutting
+    down the executor.
+    '''
+
+    def __init__(self, moltin_client, executor, add_debounce=1.0):
+        self.moltin_client = moltin_client
+        self.executor = executor
+        self.add_debounce = add_debounce
+        self._carts = {}
+        self._lock = threading.Lock()
+
+    def get_items(self, cart_id):
+        cart = self._get_loaded_cart(cart_id)
+        with cart.lock:
+            return [dict(item) for item in cart.items.values()]
+
+    def add(self, cart_id, product_id, quantity=1):
+        '''Returns the new quantity of the product in the cart'''
+        cart = self._get_loaded_cart(cart_id)
+        with cart.lock:
+            item = cart.items.get(product_id)
+        if not item:
+            item = self._make_item(product_id)
+        with cart.lock:
+            item = cart.items.setdefault(product_id, item)
+            item["quantity"] += quantity
+            cart_quantity = item["quantity"]
+            is_window_open = product_id in cart.pending_adds
+            cart.pending_adds[product_id] = (
+                cart.pending_adds.get(product_id, 0) + quantity
+            )
+            cart.synced.clear()
+        if is_window_open:
+            return cart_quantity
+        if self.add_debounce:
+            flush_timer = threading.Timer(self.add_debounce, self._flush_add,
+                                          args=(cart, product_id))
+            flush_timer.daemon = True
+            with cart.lock:
+                cart.flush_timers[product_id] = flush_timer
+            flush_timer.start()
+        else:
+            self._flush_add(cart, product_id)
+        return cart_quantity
+
+    def remove(self, cart_id, product_id):
+        cart = self._get_loaded_cart(cart_id)
+        with cart.lock:
+            item = cart.items.pop(product_id, None)
+            cart.pending_adds.pop(product_id, None)
+            self._update_synced(cart)
+        if item:
+            self._enqueue(cart, partial(self._push_remove, cart, product_id,
+                                        item["item_id"]))
+
+    def reconcile(self, cart_id, timeout=10):
+        '''Waits for pending pushes and reloads the cart from Moltin.
+        Returns False if the local copy differed from Moltin in quantities
+        or prices, or had items without a known price'''
+        cart = self._get_loaded_cart(cart_id)
+        with cart.lock:
+            pending_products = list(cart.pending_adds)
+        for product_id in pending_products:
+            self._flush_add(cart, product_id)
+        cart.synced.wait(timeout)
+        with cart.lock:
+            local_items = {product_id: (item["quantity"], item["unit_price"])
+                           for product_id, item in cart.items.items()}
+            has_unknown_prices = any(item["unit_price"] is None
+                                     for item in cart.items.values())
+        self._load(cart)
+        with cart.lock:
+            remote_items = {product_id: (item["quantity"], item["unit_price"])
+                            for product_id, item in cart.items.items()}
+        return local_items == remote_items and not has_unknown_prices
+
+    def close(self):
+        '''Stops waiting for debounce windows and pushes the pending adds
+        of all carts'''
+        self.add_debounce = 0
+        with self._lock:
+            carts = list(self._carts.values())
+        for cart in carts:
+            with cart.lock:
+                flush_timers = list(cart.flush_timers.values())
+                pending_products = list(cart.pending_adds)
+            for flush_timer in flush_timers:
+                flush_timer.cancel()
+            for product_id in pending_products:
+                self._flush_add(cart, product_id)
+
+    def forget(self, cart_id):
+        '''Drops the local copy unless it still has changes to push'''
+        with self._lock:
+            cart = self._carts.get(cart_id)
+            if cart and cart.synced.is_set():
+                del self._carts[cart_id]
+
+    def _get_cart(self, cart_id):
+        with self._lock:
+            return self._carts.setdefault(cart_id, LocalCart(cart_id))
+
+    def _get_loaded_cart(self, cart_id):
+        cart = self._get_cart(cart_id)
+        if not cart.is_loaded:
+            cart.synced.wait()
+            self._load(cart)
+        return cart
+
+    def _load(self, cart):
+        remote_items = self.moltin_client.get_cart_items(cart.cart_id)["data"]
+        with cart.lock:
+            cart.items = {
+                item["product_id"]: {
+                    "product_id": item["product_id"],
+                    "item_id": item["id"],
+                    "name": item["name"],
+                    "unit_price": item["meta"]["display_price"]["with_tax"]["unit"]["amount"],
+                    "quantity": item["quantity"],
+                }
+                for item in remote_items
+            }
+            cart.is_loaded = True
+
+    def _make_item(self, product_id):
+        product = (self.moltin_client.find_product(product_id)
+                   or self.moltin_client.get_product_data(product_id))
+        product_attrs = product["attributes"]
+        unit_price = self.moltin_client.find_product_price(product_attrs["sku"])
+        if unit_price is None:
+            # the pricebook index may be older than the catalog
+            self.moltin_client.prices_cache.refresh()
+            unit_price = self.moltin_client.find_product_price(
+                product_attrs["sku"]
+            )
+        return {
+            "product_id": product_id,
+            "item_id": None,
+            "name": product_attrs["name"],
+            "unit_price": unit_price,
+            "quantity": 0,
+        }
+
+    def _flush_add(self, cart, product_id):
+        with cart.lock:
+            cart.flush_timers.pop(product_id, None)
+            quantity = cart.pending_adds.pop(product_id, 0)
+            if not quantity:
+                self._update_synced(cart)
+                return
+        self._enqueue(cart, partial(self._push_add, cart, product_id,
+                                    quantity))
+
+    def _update_synced(self, cart):
+        if not (cart.pending_ops or cart.pending_adds or cart.is_syncing):
+            cart.synced.set()
+
+    def _enqueue(self, cart, push_op):
+        with cart.lock:
+            cart.pending_ops.append(push_op)
+            cart.synced.clear()
+            if cart.is_syncing:
+                return
+            cart.is_syncing = True
+        self.executor.submit(self._drain, cart)
+
+    def _drain(self, cart):
+        while True:
+            with cart.lock:
+                if not cart.pending_ops:
+                    cart.is_syncing = False
+                    self._update_synced(cart)
+                    return
+                push_op = cart.pending_ops.popleft()
+            try:
+                push_op()
+            except requests.exceptions.RequestException as err:
+                logger.warning(f"Не удалось обновить корзину "
+                               f"{cart.cart_id} в Moltin: {err}")
+                with cart.lock:
+                    cart.is_loaded = False
+
+    def _push_add(self, cart, product_id, quantity):
+        cart_response = self.moltin_client.add_product_to_cart(
+            cart.cart_id, product_id, quantity
+        )
+        remote_items = {item["product_id"]: item
+                        for item in cart_response.get("data", [])}
+        with cart.lock:
+            if product_id in cart.items and product_id in remote_items:
+                remote_item = remote_items[product_id]
+                local_item = cart.items[product_id]
+                local_item["item_id"] = remote_item["id"]
+                if local_item["unit_price"] is None:
+                    local_item["unit_price"] = (
+                        remote_item["meta"]["display_price"]["with_tax"]["unit"]["amount"]
+                    )
+
+    def _push_remove(self, cart, product_id, item_id):
+        if not item_id:
+            remote_items = self.moltin_client.get_cart_items(cart.cart_id)["data"]
+            item_id = next((item["id"] for item in remote_items
+                            if item["product_id"] == product_id), None)
+        if item_id:
+            self.moltin_client.delete_product_from_cart(cart.cart_id, item_id)
@@ -0,0 +1,126 @@
+import json
+import logging
+import sqlite3
+import threading
+from time import monotonic, time
+
+from telegram.error import TelegramError
+
+
+logger = logging.getLogger("TGBotLogger")
+
+
+class DelayedJobStore:
+    '''Jobs to run at a given time, kept in SQLite.
+
+    Due jobs are found through the index on due_at, so pending jobs cost
+    no memory and survive restarts. A job is deleted only after it has
+    run; a failed job is retried after retry_delay seconds up to
+    max_attempts times.
+    '''
+
+    def __init__(self, db_path, retry_delay=60, max_attempts=3):
+        self.retry_delay = retry_delay
+        self.max_attempts = max_attempts
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        # WAL without fsync on every commit: jobs survive a crash of
+        # the process, inserting one costs microseconds
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        with self._db:
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS delayed_jobs ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                "due_at REAL NOT NULL, kind TEXT NOT NULL, "
+                "payload TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 0)"
+            )
+            self._db.execute(
+                "CREATE INDEX IF NOT EXISTS delayed_jobs_due_at "
+                "ON delayed_jobs (due_at)"
+            )
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute(
+                "SELECT COUNT(*) FROM delayed_jobs"
+            ).fetchone()[0]
+
+    def schedule(self, kind, delay, **payload):
+        '''Returns job id'''
+        with self._lock, self._db:
+            cursor = self._db.execute(
+                "INSERT INTO delayed_jobs (due_at, kind, payload) "
+                "VALUES (?, ?, ?)",
+                (time() + delay, kind, json.dumps(payload))
+            )
+        return cursor.lastrowid
+
+    def get_due(self, limit=100):
+        '''Returns [(job_id, kind, payload, attempts)] of the jobs
+        whose time has come, the most overdue first'''
+        with self._lock:
+            due_jobs = self._db.execute(
+                "SELECT id, kind, payload, attempts FROM delayed_jobs "
+                "WHERE due_at <= ? ORDER BY due_at LIMIT ?",
+                (time(), limit)
+            ).fetchall()
+        return [(job_id, kind, json.loads(payload), attempts)
+                for job_id, kind, payload, attempts in due_jobs]
+
+    def finish(self, job_ids):
+        if not job_ids:
+            return
+        with self._lock, self._db:
+            self._db.executemany("DELETE FROM delayed_jobs WHERE id = ?",
+                                 [(job_id,) for job_id in job_ids])
+
+    def postpone(self, job_ids):
+        '''Moves failed jobs retry_delay seconds ahead, dropping the ones
+        that used up their attempts'''
+        if not job_ids:
+            return
+        with self._lock, self._db:
+            self._db.executemany(
+                "UPDATE delayed_jobs SET due_at = ?, attempts = attempts + 1 "
+                "WHERE id = ?",
+                [(time() + self.retry_delay, job_id) for job_id in job_ids]
+            )
+            self._db.execute("DELETE FROM delayed_jobs WHERE attempts >= ?",
+                             (self.max_attempts,))
+
+
+def run_due_jobs(store, job_runners, batch_size=100, time_budget=None):
+    '''Runs due jobs batch by batch with job_runners[kind](**payload).
+    Stops when no due jobs are left or time_budget seconds have passed.
+    Returns the number of jobs run'''
+    started_at = monotonic()
+    jobs_num = 0
+    while True:
+        due_jobs = store.get_due(batch_size)
+        finished_ids, failed_ids = [], []
+        try:
+            for job_id, kind, payload, attempts in due_jobs:
+                job_runner = job_runners.get(kind)
+                if not job_runner:
+                    logger.error(f"Неизвестная отложенная задача {kind} "
+                                 f"#{job_id} удалена")
+                    finished_ids.append(job_id)
+                    continue
+                try:
+                    job_runner(**payload)
+                except TelegramError as err:
+                    logger.warning(f"Отложенная задача {kind} #{job_id} "
+                                   f"(попытка {attempts + 1}) "
+                                   f"не выполнена: {err}")
+                    failed_ids.append(job_id)
+                    continue
+                finished_ids.append(job_id)
+        finally:
+            store.finish(finished_ids)
+            store.postpone(failed_ids)
+        jobs_num += len(finished_ids)
+        if len(due_jobs) < batch_size:
+            return jobs_num
+        if time_budget and monotonic() - started_at > time_budget:
+            return jobs_num
@@ -0,0 +1,104 @@
+import re
+import sqlite3
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from time import time
+
+
+def normalize_address(address):
+    address = address.lower().replace("ё", "е")
+    address = re.sub(r"[^\w\s]", " ", address)
+    return " ".join(address.split())
+
+
+class GeocodingCache:
+    '''LRU of geocoded addresses backed by SQLite.
+
+    Unresolvable addresses are stored too and are re-queried only after
+    negative_ttl seconds. Concurrent lookups of the same address share
+    one call to the geocoder. The normalized address is only the cache
+    key; the geocoder gets the address as the user typed it.
+    '''
+
+    def __init__(self, db_path, fetcher, maxsize=1024,
+                 negative_ttl=24 * 3600):
+        self.fetcher = fetcher
+        self.maxsize = maxsize
+        self.negative_ttl = negative_ttl
+        self._lru = OrderedDict()
+        self._in_flight = {}
+        self._lock = threading.Lock()
+        self._db_lock = threading.Lock()
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        with self._db:
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS geocodes ("
+                "address TEXT PRIMARY KEY, lat TEXT, lon TEXT, "
+                "created_at REAL NOT NULL)"
+            )
+
+    def fetch_coordinates(self, raw_address):
+        address = normalize_address(raw_address)
+        if not address:
+            return None
+        with self._lock:
+            if address in self._lru:
+                coors, created_at = self._lru[address]
+                if not self._is_expired(coors, created_at):
+                    self._lru.move_to_end(address)
+                    return coors
+                del self._lru[address]
+            future = self._in_flight.get(address)
+            is_owner = future is None
+            if is_owner:
+                future = Future()
+                self._in_flight[address] = future
+
+        if not is_owner:
+            return future.result()
+        try:
+            coors = self._load(address, raw_address.strip())
+        except Exception as err:
+            future.set_exception(err)
+            raise
+        else:
+            future.set_result(coors)
+            return coors
+        finally:
+            with self._lock:
+                del self._in_flight[address]
+
+    def _load(self, address, raw_address):
+        with self._db_lock:
+            stored = self._db.execute(
+                "SELECT lat, lon, created_at FROM geocodes WHERE address = ?",
+                (address,)
+            ).fetchone()
+        if stored:
+            lat, lon, created_at = stored
+            coors = (lat, lon) if lat is not None else None
+            if not self._is_expired(coors, created_at):
+                self._remember(address, coors, created_at)
+                return coors
+
+        coors = self.fetcher(raw_address)
+        created_at = time()
+        lat, lon = coors if coors else (None, None)
+        with self._db_lock, self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO geocodes VALUES (?, ?, ?, ?)",
+                (address, lat, lon, created_at)
+            )
+        self._remember(address, coors, created_at)
+        return coors
+
+    def _remember(self, address, coors, created_at):
+        with self._lock:
+            self._lru[address] = (coors, created_at)
+            self._lru.move_to_end(address)
+            while len(self._lru) > self.maxsize:
+                self._lru.popitem(last=False)
+
+    def _is_expired(self, coors, created_at):
+        return coors is None and time() - created_at > self.negative_ttl
@@ -0,0 +1,65 @@
+import json
+import threading
+from collections import defaultdict
+
+
+class ImportJournal:
+    '''Append-only log of finished import steps.
+
+    Every line is either {"sku", "step", "value"} for a product step
+    (create, price, image, relation) or {"image", "img_id"} for an image
+    uploaded to Moltin, so an interrupted import resumes where it stopped
+    and a picture is never uploaded twice.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self._steps = defaultdict(dict)
+        self._images = {}
+        self._lock = threading.Lock()
+        self._image_locks = defaultdict(threading.Lock)
+        try:
+            with open(path, "r", encoding="utf-8") as file:
+                for line in file:
+                    self._replay(line)
+        except FileNotFoundError:
+            pass
+
+    def _replay(self, line):
+        try:
+            record = json.loads(line)
+        except json.JSONDecodeError:
+            return
+        if "image" in record:
+            self._images[record["image"]] = record["img_id"]
+        else:
+            self._steps[record["sku"]][record["step"]] = record["value"]
+
+    def _append(self, record):
+        with open(self.path, "a", encoding="utf-8") as file:
+            file.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    def __contains__(self, sku):
+        return sku in self._steps
+
+    def get_steps(self, sku):
+        with self._lock:
+            return dict(self._steps.get(sku, {}))
+
+    def record(self, sku, step, value=True):
+        with self._lock:
+            self._steps[sku][step] = value
+            self._append({"sku": sku, "step": step, "value": value})
+
+    def get_or_add_image(self, image_key, add_img):
+        with self._lock:
+            image_lock = self._image_locks[image_key]
+        with image_lock:
+            img_id = self._images.get(image_key)
+            if img_id:
+                return img_id
+            img_id = add_img()
+            with self._lock:
+                self._images[image_key] = img_id
+                self._append({"image": image_key, "img_id": img_id})
+            return img_id
@@ -0,0 +1,497 @@
+import argparse
+import json
+import logging
+import os
+import pathlib
+import socket
+import tempfile
+import threading
+import urllib.request
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from itertools import count
+from queue import Queue
+from time import perf_counter, sleep, time
+
+import numpy as np
+from telegram import Update
+from telegram.ext import Defaults, Dispatcher, JobQueue, Updater
+from telegram.utils.request import Request
+
+import bot
+from bot_helpers import MenuPages, fetch_coordinates
+from cart_mirror import CartMirror
+from delayed_jobs import DelayedJobStore
+from geocoding_cache import GeocodingCache
+from media_cache import ProductImageStore, TelegramFileIdCache
+from metrics import metrics
+from moltin_handlers import MoltinClient
+from send_scheduler import ScheduledBot, SendScheduler
+from sqlite_persistence import SQLitePersistence
+from stub_servers import MoltinStub, TelegramStub, YandexGeocoderStub
+
+
+ADMIN_CHAT_ID = 1
+
+SCENARIO_STEPS = (
+    ("start", "—"),
+    ("show_menu", "SHOW_MENU"),
+    ("next_page", "HANDLE_MENU"),
+    ("product", "HANDLE_MENU"),
+    ("add_to_cart", "HANDLE_DESCRIPTION"),
+    ("cart", "HANDLE_DESCRIPTION"),
+    ("checkout", "HANDLE_CART"),
+    ("location", "WAITING_LOCATION"),
+    ("delivery", "HANDLE_DELIVERY_METHOD"),
+    ("precheckout", "—"),
+    ("payment", "—"),
+)
+
+
+def get_args():
+    parser = argparse.ArgumentParser(
+        description="Нагрузочный тест бота на локальных заглушках Moltin, "
+                    "Telegram и Яндекс-геокодера"
+    )
+    parser.add_argument("-u", "--users",
+                        type=int,
+                        default=50,
+                        help="Number of simulated users going through "
+                             "the order flow at once")
+    parser.add_argument("--intake",
+                        choices=("queue", "webhook"),
+                        default="queue",
+                        help="Put updates on the update queue or POST them "
+                             "to the webhook server of the bot")
+    parser.add_argument("--steps",
+                        type=int,
+                        default=len(SCENARIO_STEPS),
+                        help="Stop every user after this many steps of "
+                             "the scenario")
+    parser.add_argument("--think_time",
+                        type=float,
+                        default=0,
+                        help="Pause of a user between steps, seconds")
+    parser.add_argument("--products",
+                        type=int,
+                        default=50,
+                        help="Number of products in the stub catalog")
+    parser.add_argument("--pizzerias",
+                        type=int,
+                        default=100,
+                        help="Number of pizzerias in the stub store")
+    parser.add_argument("--addresses",
+                        type=int,
+                        default=20,
+                        help="Number of distinct addresses users type in")
+    for api in ("moltin", "telegram", "yandex"):
+        parser.add_argument(f"--{api}_latency",
+                            type=float,
+                            default=0.05,
+                            help=f"Delay of every {api} stub response, "
+                                 f"seconds")
+        parser.add_argument(f"--{api}_jitter",
+                            type=float,
+                            default=0.02,
+                            help=f"Random spread of the {api} stub delay, "
+                                 f"seconds")
+        parser.add_argument(f"--{api}_error_rate",
+                            type=float,
+                            default=0,
+                            help=f"Share of {api} stub responses that are "
+                                 f"errors")
+    parser.add_argument("--tg_global_rate",
+                        type=float,
+                        default=30,
+                        help="TG_GLOBAL_RATE of the tested bot")
+    parser.add_argument("--tg_chat_rate",
+                        type=float,
+                        default=1,
+                        help="TG_CHAT_RATE of the tested bot")
+    parser.add_argument("--tg_workers",
+                        type=int,
+                        default=4,
+                        help="TG_WORKERS of the tested bot")
+    parser.add_argument("--tg_run_async",
+                        action=argparse.BooleanOptionalAction,
+                        default=False,
+                        help="TG_RUN_ASYNC of the tested bot")
+    parser.add_argument("--cart_add_debounce",
+                        type=float,
+                        default=1.0,
+                        help="CART_ADD_DEBOUNCE of the tested bot")
+    parser.add_argument("-o", "--output",
+                        help="Save the results to this JSON file")
+    return parser.parse_args()
+
+
+class SimulatedUser:
+    '''Builds the updates Telegram would send for one customer'''
+
+    def __init__(self, user_id, update_ids, tg_bot, product_id, address):
+        self.user_id = user_id
+        self.update_ids = update_ids
+        self.tg_bot = tg_bot
+        self.product_id = product_id
+        self.address = address
+        self.message_ids = count(1)
+
+    def iter_steps(self):
+        yield self.make_message_update(
+            text="/start",
+            entities=[{"type": "bot_command", "offset": 0, "length": 6}]
+        )
+        yield self.make_callback_update("show_menu")
+        yield self.make_callback_update("next_page")
+        yield self.make_callback_update(self.product_id)
+        yield self.make_callback_update(self.product_id, with_photo=True)
+        yield self.make_callback_update("cart", with_photo=True)
+        yield self.make_callback_update("check_out")
+        yield self.make_message_update(text=self.address)
+        yield self.make_callback_update("delivery")
+        yield self.make_update(pre_checkout_query={
+            "id": f"precheckout-{self.user_id}",
+            "from": self.get_user(),
+            "currency": "RUB",
+            "total_amount": 100,
+            "invoice_payload": "PizzaPayment",
+        })
+        yield self.make_message_update(successful_payment={
+            "currency": "RUB",
+            "total_amount": 100,
+            "invoice_payload": "PizzaPayment",
+            "telegram_payment_charge_id": f"tg-{self.user_id}",
+            "provider_payment_charge_id": f"provider-{self.user_id}",
+        })
+
+    def get_user(self):
+        return {"id": self.user_id, "is_bot": False,
+                "first_name": f"User{self.user_id}"}
+
+    def make_message(self, **fields):
+        return {
+            "message_id": next(self.message_ids),
+            "date": int(time()),
+            "chat": {"id": self.user_id, "type": "private"},
+            "from": self.get_user(),
+            **fields,
+        }
+
+    def make_update(self, **fields):
+        return Update.de_json({"update_id": next(self.update_ids), **fields},
+                              self.tg_bot)
+
+    def make_message_update(self, **fields):
+        return self.make_update(message=self.make_message(**fields))
+
+    def make_callback_update(self, data, with_photo=False):
+        if with_photo:
+            message = self.make_message(
+                photo=[{"file_id": "photo", "file_unique_id": "photo",
+                        "width": 1, "height": 1}],
+                caption=""
+            )
+        else:
+            message = self.make_message(text="Пожалуйста, выберите товар:")
+        return self.make_update(callback_query={
+            "id": f"query-{self.user_id}-{message['message_id']}",
+            "from": self.get_user(),
+            "chat_instance": str(self.user_id),
+            "data": data,
+            "message": message,
+        })
+
+
+class TracedDispatcher(Dispatcher):
+    '''Dispatcher that tells when an update is fully handled, including
+    the handlers it ran on the worker threads'''
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._traces = {}
+        self._traces_lock = threading.Lock()
+
+    def expect(self, update_id):
+        with self._traces_lock:
+            self._traces[update_id] = (threading.Event(), [])
+
+    def wait_handled(self, update_id):
+        processed, promises = self._traces[update_id]
+        processed.wait()
+        for promise in promises:
+            promise.done.wait()
+        with self._traces_lock:
+            del self._traces[update_id]
+
+    def process_update(self, update):
+        super().process_update(update)
+        trace = self._traces.get(getattr(update, "update_id", None))
+        if trace:
+            trace[0].set()
+
+    def run_async(self, func, *args, update=None, **kwargs):
+        promise = super().run_async(func, *args, update=update, **kwargs)
+        trace = self._traces.get(getattr(update, "update_id", None))
+        if trace and not trace[0].is_set():
+            trace[1].append(promise)
+        return promise
+
+
+def create_updater(args, moltin_stub, telegram_stub, yandex_stub):
+    '''Wires the bot the same way bot.main does, with the same workers
+    and run_async setting, but against the stub servers'''
+    tg_bot = ScheduledBot(
+        "123456:stub",
+        SendScheduler(global_rate=args.tg_global_rate,
+                      chat_rate=args.tg_chat_rate),
+        base_url=f"{telegram_stub.base_url}/bot",
+        defaults=Defaults(run_async=args.tg_run_async),
+        request=Request(con_pool_size=args.tg_workers + 4)
+    )
+    persistence = SQLitePersistence("bot_state.sqlite3", store_bot_data=False)
+    dispatcher = TracedDispatcher(tg_bot,
+                                  Queue(),
+                                  workers=args.tg_workers,
+                                  exception_event=threading.Event(),
+                                  job_queue=JobQueue(),
+                                  persistence=persistence)
+    updater = Updater(dispatcher=dispatcher, workers=None)
+    updater.job_queue.set_dispatcher(dispatcher)
+
+    moltin_client = MoltinClient("stub", "stub")
+    moltin_client.base_url = moltin_stub.base_url
+    executor = ThreadPoolExecutor(max_workers=8)
+    dispatcher.bot_data["yandex_api_key"] = "stub"
+    dispatcher.bot_data["merchant_token"] = "stub"
+    dispatcher.bot_data["file_ids_cache"] = TelegramFileIdCache(
+        "images/telegram_file_ids.json"
+    )
+    dispatcher.bot_data["image_store"] = ProductImageStore("images/")
+    dispatcher.bot_data["geocoding_cache"] = GeocodingCache(
+        "geocoding_cache.sqlite3",
+        partial(fetch_coordinates, "stub",
+                base_url=f"{yandex_stub.base_url}/1.x")
+    )
+    dispatcher.bot_data["delayed_jobs"] = DelayedJobStore(
+        "delayed_jobs.sqlite3"
+    )
+    dispatcher.bot_data["moltin_client"] = moltin_client
+    dispatcher.bot_data["menu_pages"] = MenuPages(moltin_client)
+    dispatcher.bot_data["executor"] = executor
+    dispatcher.bot_data["cart_mirror"] = CartMirror(
+        moltin_client, executor, add_debounce=args.cart_add_debounce
+    )
+    bot.add_handlers(dispatcher, 3600, ADMIN_CHAT_ID)
+    return updater
+
+
+def start_updater(updater):
+    '''Starts the job queue and the dispatcher with its worker threads,
+    as start_polling would, without polling'''
+    updater.job_queue.start()
+    dispatcher_ready = threading.Event()
+    threading.Thread(target=updater.dispatcher.start,
+                     args=(dispatcher_ready,),
+                     daemon=True).start()
+    dispatcher_ready.wait()
+
+
+def stop_updater(updater):
+    updater.job_queue.stop()
+    updater.dispatcher.stop()
+
+
+def start_webhook(updater):
+    '''Starts the bot in webhook mode on a free local port.
+    Returns the webhook URL to post updates to'''
+    with socket.socket() as free_socket:
+        free_socket.bind(("127.0.0.1", 0))
+        port = free_socket.getsockname()[1]
+    updater.start_webhook(listen="127.0.0.1",
+                          port=port,
+                          url_path="webhook",
+                          webhook_url="https://example.com/webhook")
+    return f"http://127.0.0.1:{port}/webhook"
+
+
+def post_to_webhook(webhook_url, update):
+    request = urllib.request.Request(
+        webhook_url,
+        data=update.to_json().encode(),
+        headers={"Content-Type": "application/json"}
+    )
+    with urllib.request.urlopen(request, timeout=10) as response:
+        response.read()
+
+
+def run_user(updater, user, post_update, steps_num, think_time, latencies,
+             steps_by_update):
+    '''Sends the updates of the user one after another, waiting for
+    each to be handled like a customer waits for the answer'''
+    dispatcher = updater.dispatcher
+    for (step, _), update in zip(SCENARIO_STEPS[:steps_num],
+                                 user.iter_steps()):
+        steps_by_update[update.update_id] = step
+        dispatcher.expect(update.update_id)
+        started_at = perf_counter()
+        post_update(update)
+        dispatcher.wait_handled(update.update_id)
+        latencies[step].append(perf_counter() - started_at)
+        if think_time:
+            sleep(think_time)
+
+
+def run_load_test(args, moltin_stub, telegram_stub, yandex_stub):
+    updater = create_updater(args, moltin_stub, telegram_stub, yandex_stub)
+    dispatcher = updater.dispatcher
+    latencies = defaultdict(list)
+    errors = defaultdict(int)
+    steps_by_update = {}
+    errors_lock = threading.Lock()
+
+    def count_error(update, context):
+        step = steps_by_update.get(getattr(update, "update_id", None), "?")
+        with errors_lock:
+            errors[step] += 1
+
+    dispatcher.add_error_handler(count_error)
+
+    update_ids = count(1)
+    product_ids = list(moltin_stub.products)
+    users = [
+        SimulatedUser(user_id=10_000 + num,
+                      update_ids=update_ids,
+                      tg_bot=updater.bot,
+                      product_id=product_ids[num % len(product_ids)],
+                      address=f"Москва, улица Тестовая, {num % args.addresses}")
+        for num in range(args.users)
+    ]
+    if args.intake == "webhook":
+        post_update = partial(post_to_webhook, start_webhook(updater))
+    else:
+        start_updater(updater)
+        post_update = updater.update_queue.put
+    started_at = perf_counter()
+    with ThreadPoolExecutor(max_workers=args.users) as users_executor:
+        users_futures = [
+            users_executor.submit(run_user, updater, user, post_update,
+                                  args.steps, args.think_time, latencies,
+                                  steps_by_update)
+            for user in users
+        ]
+        for user_future in users_futures:
+            user_future.result()
+    elapsed = perf_counter() - started_at
+    if args.intake == "webhook":
+        updater.stop()
+    else:
+        stop_updater(updater)
+    dispatcher.bot_data["cart_mirror"].close()
+    dispatcher.bot_data["executor"].shutdown(wait=True)
+    dispatcher.update_persistence()
+    dispatcher.persistence.close()
+    return elapsed, latencies, errors, count_lost_states(users, args.steps)
+
+
+def get_expected_state(steps_num):
+    '''Name of the conversation state the bot keeps after the first
+    steps_num steps of the scenario'''
+    for _, state in SCENARIO_STEPS[steps_num:]:
+        if state != "—":
+            return state
+    return "HANDLE_DELIVERY_METHOD"
+
+
+def count_lost_states(users, steps_num):
+    '''Reads conversation states back the way a restarted bot does and
+    returns the number of users whose stored state is not the expected
+    one'''
+    expected_state = get_expected_state(steps_num)
+    persistence = SQLitePersistence("bot_state.sqlite3",
+                                    store_bot_data=False)
+    conversations = persistence.get_conversations("pizza_order")
+    lost_num = 0
+    for user in users:
+        state = conversations.get((user.user_id, user.user_id))
+        if getattr(state, "name", state) != expected_state:
+            logging.error(f"Пользователь {user.user_id}: после перезапуска "
+                          f"состояние {state}, а не {expected_state}")
+            lost_num += 1
+    persistence.close()
+    return lost_num
+
+
+def get_results(args, elapsed, latencies, errors, lost_states_num):
+    steps = []
+    for step, state in SCENARIO_STEPS:
+        step_latencies = np.array(latencies[step]) * 1000
+        p50, p95, p99 = (np.percentile(step_latencies, (50, 95, 99))
+                         if len(step_latencies) else (0, 0, 0))
+        steps.append({"step": step, "state": state,
+                      "count": len(step_latencies), "errors": errors[step],
+                      "p50_ms": p50, "p95_ms": p95, "p99_ms": p99})
+    updates_num = sum(step["count"] for step in steps)
+    return {
+        "users": args.users,
+        "elapsed_s": elapsed,
+        "users_per_s": args.users / elapsed,
+        "updates_per_s": updates_num / elapsed,
+        "errors": sum(errors.values()),
+        "lost_states": lost_states_num,
+        "steps": steps,
+    }
+
+
+def print_results(results):
+    print(f"Пользователей: {results['users']}, "
+          f"время: {results['elapsed_s']:.1f} с, "
+          f"заказов в секунду: {results['users_per_s']:.1f}, "
+          f"обновлений в секунду: {results['updates_per_s']:.1f}, "
+          f"ошибок: {results['errors']}, "
+          f"состояний потеряно после перезапуска: {results['lost_states']}")
+    print(f"{'шаг':<14}{'состояние':<24}{'кол-во':>8}{'ошибок':>8}"
+          f"{'p50, мс':>10}{'p95, мс':>10}{'p99, мс':>10}")
+    for step in results["steps"]:
+        print(f"{step['step']:<14}{step['state']:<24}{step['count']:>8}"
+              f"{step['errors']:>8}{step['p50_ms']:>10.1f}"
+              f"{step['p95_ms']:>10.1f}{step['p99_ms']:>10.1f}")
+    print()
+    print(metrics.get_report())
+
+
+def main():
+    logging.basicConfig(
+        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+        level=logging.ERROR)
+    args = get_args()
+
+    moltin_stub = MoltinStub(products_num=args.products,
+                             pizzerias_num=args.pizzerias,
+                             latency=args.moltin_latency,
+                             jitter=args.moltin_jitter,
+                             error_rate=args.moltin_error_rate).start()
+    telegram_stub = TelegramStub(latency=args.telegram_latency,
+                                 jitter=args.telegram_jitter,
+                                 error_rate=args.telegram_error_rate).start()
+    yandex_stub = YandexGeocoderStub(latency=args.yandex_latency,
+                                     jitter=args.yandex_jitter,
+                                     error_rate=args.yandex_error_rate).start()
+    output_path = os.path.abspath(args.output) if args.output else None
+    with tempfile.TemporaryDirectory() as workdir:
+        os.chdir(workdir)
+        pathlib.Path("images/").mkdir()
+        elapsed, latencies, errors, lost_states_num = run_load_test(
+            args, moltin_stub, telegram_stub, yandex_stub)
+    for stub in (moltin_stub, telegram_stub, yandex_stub):
+        stub.stop()
+
+    results = get_results(args, elapsed, latencies, errors, lost_states_num)
+    print_results(results)
+    if output_path:
+        with open(output_path, "w", encoding="utf-8") as file:
+            json.dump(results, file, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
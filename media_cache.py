@@ -0,0 +1,153 @@
+import hashlib
+import io
+import json
+import os
+import pathlib
+import threading
+from concurrent.futures import Future, as_completed
+from urllib.parse import urlsplit, unquote
+
+import requests
+from PIL import Image, ImageOps
+
+
+class TelegramFileIdCache:
+    '''Maps Moltin image ids to Telegram file_id of already sent photos'''
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        try:
+            with open(path, "r", encoding="utf-8") as file:
+                self._file_ids = json.load(file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            self._file_ids = {}
+
+    def get(self, img_id):
+        return self._file_ids.get(img_id)
+
+    def set(self, img_id, file_id):
+        with self._lock:
+            self._file_ids[img_id] = file_id
+            self._save()
+
+    def delete(self, img_id):
+        with self._lock:
+            if self._file_ids.pop(img_id, None):
+                self._save()
+
+    def _save(self):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as file:
+            json.dump(self._file_ids, file)
+        os.replace(tmp_path, self.path)
+
+
+def optimize_image(content, max_side=1280, quality=85):
+    '''Re-encodes the image as JPEG no larger than max_side pixels on
+    the long side, the size Telegram scales photos to anyway'''
+    with Image.open(io.BytesIO(content)) as image:
+        scale = min(max_side / max(image.size), 1)
+        image.draft("RGB", (round(image.width * scale),
+                            round(image.height * scale)))
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((max_side, max_side), Image.LANCZOS,
+                        reducing_gap=3.0)
+        if image.mode != "RGB":
+            image = image.convert("RGBA")
+            background = Image.new("RGB", image.size, (255, 255, 255))
+            background.paste(image, mask=image.getchannel("A"))
+            image = background
+        optimized = io.BytesIO()
+        image.save(optimized, "JPEG", quality=quality, optimize=True,
+                   progressive=True)
+    return optimized.getvalue()
+
+
+class ProductImageStore:
+    '''Optimized product photos stored by content hash.
+
+    Files are named after the SHA-256 of their content, so products
+    sharing a photo share a file. The image id -> path index lives in
+    memory and in index.json. Concurrent requests for the same image
+    share one download.
+    '''
+
+    def __init__(self, directory):
+        self.directory = pathlib.Path(directory)
+        self.index_path = self.directory / "index.json"
+        self.prefetched_version = None
+        self._lock = threading.Lock()
+        self._in_flight = {}
+        try:
+            with open(self.index_path, "r", encoding="utf-8") as file:
+                index = json.load(file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            index = {}
+        self._paths = {img_id: self.directory / filename
+                       for img_id, filename in index.items()
+                       if (self.directory / filename).exists()}
+
+    def __len__(self):
+        return len(self._paths)
+
+    def get(self, img_id):
+        return self._paths.get(img_id)
+
+    def fetch(self, moltin_client, img_id):
+        '''Returns path to the optimized photo, downloading it if needed'''
+        path = self._paths.get(img_id)
+        if path:
+            return path
+        with self._lock:
+            future = self._in_flight.get(img_id)
+            is_owner = future is None
+            if is_owner:
+                future = self._in_flight[img_id] = Future()
+        if not is_owner:
+            return future.result()
+        try:
+            path = self._download(moltin_client, img_id)
+            future.set_result(path)
+            return path
+        except Exception as err:
+            future.set_exception(err)
+            raise
+        finally:
+            with self._lock:
+                self._in_flight.pop(img_id, None)
+
+    def prefetch(self, moltin_client, img_ids, executor):
+        '''Downloads missing photos concurrently. Returns the number of
+        photos that could not be downloaded'''
+        futures = [executor.submit(self.fetch, moltin_client, img_id)
+                   for img_id in set(img_ids) if img_id not in self._paths]
+        failed_num = 0
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except (requests.exceptions.RequestException, OSError):
+                failed_num += 1
+        return failed_num
+
+    def _download(self, moltin_client, img_id):
+        img_url = moltin_client.get_file(img_id)["link"]["href"]
+        content = moltin_client.download_file(img_url)
+        try:
+            content, ext = optimize_image(content), ".jpg"
+        except (OSError, ValueError):
+            ext = os.path.splitext(urlsplit(unquote(img_url)).path)[1]
+        filename = f"{hashlib.sha256(content).hexdigest()}{ext}"
+        path = self.directory / filename
+        if not path.exists():
+            tmp_path = path.with_name(f"{filename}.{img_id}.tmp")
+            tmp_path.write_bytes(content)
+            os.replace(tmp_path, path)
+        with self._lock:
+            self._paths[img_id] = path
+            index = {img_id: path.name for img_id, path in self._paths.items()}
+            tmp_index_path = f"{self.index_path}.tmp"
+            with open(tmp_index_path, "w", encoding="utf-8") as file:
+                json.dump(index, file)
+            os.replace(tmp_index_path, self.index_path)
+        return path
@@ -0,0 +1,182 @@
+import re
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import perf_counter
+
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1, 2.5, 5, 10, float("inf"))
+
+
+class Histogram:
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.total = 0
+        self.count = 0
+        self.errors = 0
+
+    def observe(self, value, is_error=False):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.total += value
+        self.count += 1
+        if is_error:
+            self.errors += 1
+
+    def get_quantile(self, quantile):
+        '''Estimates the quantile by interpolating inside its bucket'''
+        if not self.count:
+            return 0
+        rank = quantile * self.count
+        seen = 0
+        lower_bound = 0
+        for upper_bound, bucket_count in zip(self.buckets, self.counts):
+            if bucket_count and seen + bucket_count >= rank:
+                if upper_bound == float("inf"):
+                    return lower_bound
+                share = (rank - seen) / bucket_count
+                return lower_bound + (upper_bound - lower_bound) * share
+            seen += bucket_count
+            lower_bound = upper_bound
+        return lower_bound
+
+
+class MetricsRegistry:
+    '''Latency histograms and error counts keyed by metric and label'''
+
+    def __init__(self):
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def observe(self, metric, label, seconds, is_error=False):
+        with self._lock:
+            histogram = self._histograms.get((metric, label))
+            if not histogram:
+                histogram = self._histograms[(metric, label)] = Histogram()
+            histogram.observe(seconds, is_error)
+
+    @contextmanager
+    def timer(self, metric, label):
+        started_at = perf_counter()
+        try:
+            yield
+        except Exception:
+            self.observe(metric, label, perf_counter() - started_at, True)
+            raise
+        self.observe(metric, label, perf_counter() - started_at)
+
+    def get_histograms(self):
+        with self._lock:
+            return sorted(self._histograms.items())
+
+    def render_prometheus(self):
+        '''Every metric family is written as one block: first all samples
+        of the histogram, then all samples of its error counter'''
+        histograms_by_metric = {}
+        for (metric, label), histogram in self.get_histograms():
+            histograms_by_metric.setdefault(metric, []).append(
+                (label, histogram)
+            )
+        lines = []
+        for metric, histograms in histograms_by_metric.items():
+            lines.append(f"# TYPE {metric}_seconds histogram")
+            for label, histogram in histograms:
+                cumulative_count = 0
+                for upper_bound, bucket_count in zip(histogram.buckets,
+                                                     histogram.counts):
+                    cumulative_count += bucket_count
+                    le = "+Inf" if upper_bound == float("inf") else upper_bound
+                    lines.append(f'{metric}_seconds_bucket{{name="{label}",'
+                                 f'le="{le}"}} {cumulative_count}')
+                lines.append(f'{metric}_seconds_sum{{name="{label}"}} '
+                             f'{histogram.total}')
+                lines.append(f'{metric}_seconds_count{{name="{label}"}} '
+                             f'{histogram.count}')
+            lines.append(f"# TYPE {metric}_errors_total counter")
+            for label, histogram in histograms:
+                lines.append(f'{metric}_errors_total{{name="{label}"}} '
+                             f'{histogram.errors}')
+        return "\n".join(lines) + "\n"
+
+    def get_report(self):
+        lines = ["Задержки с момента запуска (p50 / p95 / p99, мс):"]
+        for (metric, label), histogram in self.get_histograms():
+            p50, p95, p99 = [histogram.get_quantile(quantile) * 1000
+                             for quantile in (0.5, 0.95, 0.99)]
+            line = (f"{metric}:{label} — {histogram.count} шт., "
+                    f"{p50:.0f} / {p95:.0f} / {p99:.0f}")
+            if histogram.errors:
+                line += f", ошибок: {histogram.errors}"
+            lines.append(line)
+        return "\n".join(lines)
+
+
+metrics = MetricsRegistry()
+
+
+def measure(metric):
+    '''Records latency and errors of the decorated function under its name'''
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with metrics.timer(metric, func.__name__):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def get_endpoint_label(method, path):
+    '''Replaces ids in the request path so that all carts, products
+    and files share one label per endpoint'''
+    path = re.sub(r"^https?://[^/]+", "", path.split("?")[0])
+    segments = ["{id}" if re.fullmatch(r"\d+|[0-9a-f-]{16,}", segment)
+                else segment
+                for segment in path.split("/")]
+    return f"{method} {'/'.join(segments)}"
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = metrics.render_prometheus().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        action = self.server.post_actions.get(self.path)
+        if not action:
+            self.send_error(404)
+            return
+        try:
+            body = str(action()).encode()
+        except Exception as err:
+            self.send_error(500, explain=str(err))
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(port, host="127.0.0.1", post_actions=None):
+    '''Serves /metrics and runs post_actions[path]() on POST to path,
+    answering with what it returns'''
+    server = ThreadingHTTPServer((host, port), MetricsRequestHandler)
+    server.post_actions = post_actions or {}
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
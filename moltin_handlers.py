@@ -1,261 +1,427 @@
-import requests
-
+import logging
+import threading
+from time import monotonic
 
-def add_img(token, img_url):
-    ''' Returns image id '''
-    endpoint = "https://api.moltin.com/v2/files"
-    headers = {"Authorization": f"Bearer {token}"}
-    files = {
-        "file_location": (None, img_url),
-    }
-    response = requests.post(endpoint, headers=headers, files=files)
-    response.raise_for_status()
-    return response.json()["data"]["id"]
-
-
-def add_product_price(token, product_sku, price):
-    price_book_id = "902947fd-5c0e-4a86-83b1-d347be42426a"
-    endpoint = f"https://api.moltin.com/pcm/pricebooks/{price_book_id}/prices"
-    headers = {
-        "Authorization": f"Bearer {token}",
-        "Content-Type": "application/json"
-    }
-    body = {
-        "data": {
-            "type": "product-price",
-            "attributes": {
-                "sku": product_sku,
-                "currencies": {
-                    "RUB": {
-                        "amount": price,
-                        "includes_tax": True,
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from metrics import get_endpoint_label, metrics
+from pizzerias_index import PizzeriasIndex
+
+
+logger = logging.getLogger("TGBotLogger")
+
+PRICE_BOOK_ID = "902947fd-5c0e-4a86-83b1-d347be42426a"
+
+
+class CatalogCache:
+    '''Keeps data loaded from Moltin in memory and refreshes it in the
+    background once it becomes older than ttl seconds. Callers that find
+    the cache empty share one load'''
+
+    def __init__(self, loader, ttl=300):
+        self.loader = loader
+        self.ttl = ttl
+        self.version = 0
+        self._data = None
+        self._loaded_at = None
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self._refresh_thread = None
+
+    def get(self, *loader_args):
+        return self.get_versioned(*loader_args)[0]
+
+    def get_versioned(self, *loader_args):
+        '''Returns (data, version) read together, so data is never paired
+        with the version of a refresh that replaced it'''
+        with self._lock:
+            data, version = self._data, self.version
+            loaded_at = self._loaded_at
+        if data is None:
+            return self._load(*loader_args)
+        if monotonic() - loaded_at > self.ttl:
+            self._refresh_in_background(*loader_args)
+        return data, version
+
+    def refresh(self, *loader_args):
+        return self._store(self.loader(*loader_args))[0]
+
+    def _load(self, *loader_args):
+        with self._load_lock:
+            with self._lock:
+                data, version = self._data, self.version
+            if data is None:
+                data, version = self._store(self.loader(*loader_args))
+        return data, version
+
+    def _store(self, data):
+        with self._lock:
+            self._data = data
+            self._loaded_at = monotonic()
+            self.version += 1
+            return data, self.version
+
+    def invalidate(self):
+        with self._lock:
+            self._data = None
+            self._loaded_at = None
+
+    def _refresh_in_background(self, *loader_args):
+        with self._lock:
+            if self._refresh_thread and self._refresh_thread.is_alive():
+                return
+            self._refresh_thread = threading.Thread(
+                target=self._safe_refresh, args=loader_args, daemon=True
+            )
+            self._refresh_thread.start()
+
+    def _safe_refresh(self, *loader_args):
+        try:
+            self.refresh(*loader_args)
+        except requests.exceptions.RequestException as err:
+            logger.warning(f"Не удалось обновить кэш Moltin: {err}")
+
+
+class MoltinRetry(Retry):
+    '''Retries 429 for every method and 5xx only for idempotent ones,
+    so a POST to a cart is never sent twice'''
+
+    def is_retry(self, method, status_code, has_retry_after=False):
+        if status_code == 429:
+            return bool(self.total)
+        return super().is_retry(method, status_code, has_retry_after)
+
+
+class MoltinClient:
+    base_url = "https://api.moltin.com"
+
+    def __init__(self, client_id, secret_key, pool_size=10, timeout=10,
+                 retries=3, backoff_factor=0.5, rate_limiter=None,
+                 token_refresh_margin=120):
+        self.client_id = client_id
+        self.secret_key = secret_key
+        self.timeout = timeout
+        self.rate_limiter = rate_limiter
+        self.token_refresh_margin = token_refresh_margin
+        self.token = None
+        self.token_expires_at = None
+        self._token_lock = threading.Lock()
+        self._token_refresh_lock = threading.Lock()
+        self._token_refresh_thread = None
+        self.session = requests.Session()
+        retry = MoltinRetry(total=retries,
+                            backoff_factor=backoff_factor,
+                            status_forcelist=(500, 502, 503, 504),
+                            raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=pool_size,
+                              pool_maxsize=pool_size,
+                              max_retries=retry)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.products_cache = CatalogCache(self.fetch_products)
+        self.prices_cache = CatalogCache(self.fetch_price_index)
+        self.pizzerias_cache = CatalogCache(self.fetch_pizzerias_index)
+
+    def request(self, method, path, headers=None, **kwargs):
+        '''Sends the request with a valid token. On 401 the token is
+        refreshed and the request is sent once more'''
+        url = path if path.startswith("http") else f"{self.base_url}{path}"
+        kwargs.setdefault("timeout", self.timeout)
+        token = self.get_token()
+        with metrics.timer("moltin_request", get_endpoint_label(method, path)):
+            response = self._send(method, url, token, headers, **kwargs)
+            if response.status_code == 401:
+                token = self.refresh_token(expired_token=token)
+                response = self._send(method, url, token, headers, **kwargs)
+            response.raise_for_status()
+        return response
+
+    def get_token(self):
+        '''Returns the current token. A token close to expiry is
+        refreshed in the background, an expired one right away'''
+        with self._token_lock:
+            token, expires_at = self.token, self.token_expires_at
+        if token is None or monotonic() >= expires_at:
+            return self.refresh_token(expired_token=token)
+        if monotonic() >= expires_at - self.token_refresh_margin:
+            self._refresh_token_in_background(token)
+        return token
+
+    def refresh_token(self, expired_token=None):
+        '''Returns the new token. Concurrent callers that saw the same
+        expired token share one request to Moltin'''
+        with self._token_refresh_lock:
+            with self._token_lock:
+                if self.token is not None and self.token != expired_token:
+                    return self.token
+            with metrics.timer("moltin_request", "POST /oauth/access_token"):
+                response = self.session.post(
+                    f"{self.base_url}/oauth/access_token",
+                    data={
+                        "client_id": self.client_id,
+                        "client_secret": self.secret_key,
+                        "grant_type": "client_credentials",
+                    },
+                    timeout=self.timeout
+                )
+                response.raise_for_status()
+            token_details = response.json()
+            with self._token_lock:
+                self.token = token_details["access_token"]
+                self.token_expires_at = (monotonic()
+                                         + token_details["expires_in"])
+            return self.token
+
+    def add_img(self, img_url):
+        ''' Returns image id '''
+        files = {
+            "file_location": (None, img_url),
+        }
+        response = self.request("POST", "/v2/files", files=files)
+        return response.json()["data"]["id"]
+
+    def add_product_price(self, product_sku, price):
+        body = {
+            "data": {
+                "type": "product-price",
+                "attributes": {
+                    "sku": product_sku,
+                    "currencies": {
+                        "RUB": {
+                            "amount": price,
+                            "includes_tax": True,
+                        }
                     }
                 }
-            }
-        },
-    }
-    response = requests.post(endpoint, headers=headers, json=body)
-    response.raise_for_status()
-
-
-def add_product_to_cart(token, cart_id, product_id):
-    endpoint = f"https://api.moltin.com/v2/carts/{cart_id}/items"
-    headers = {"Authorization": f"Bearer {token}"}
-    data = {
-      "data": {
-          "id": product_id,
-          "type": "cart_item",
-          "quantity": 1
+            },
         }
-      }
-    response = requests.post(endpoint, headers=headers, json=data)
-    response.raise_for_status()
-    return response.json()
-
-
-def create_catalog(token):
-    endpoint = "https://api.moltin.com/pcm/catalogs"
-    headers = {"Authorization": f"Bearer {token}"}
-    pizzeria_hierarchy_id = "6141ab1d-fe67-4eff-88d3-d5f1fca6f51c"
-    pizzeria_price_book = "902947fd-5c0e-4a86-83b1-d347be42426a"
-    body = {
-        "data": {
-        "type": "catalog",
-        "attributes": {
-            "name": "Pizzas catalog",
-            "hierarchy_ids": [
-                pizzeria_hierarchy_id
-            ],
-            "pricebook_id": pizzeria_price_book,
-            "description": "Pizzeria catalog"
+        self.request("POST", f"/pcm/pricebooks/{PRICE_BOOK_ID}/prices",
+                     json=body)
+
+    def add_product_to_cart(self, cart_id, product_id, quantity=1):
+        data = {
+          "data": {
+              "id": product_id,
+              "type": "cart_item",
+              "quantity": quantity
+            }
+          }
+        response = self.request("POST", f"/v2/carts/{cart_id}/items",
+                                json=data)
+        return response.json()
+
+    def create_catalog(self):
+        pizzeria_hierarchy_id = "6141ab1d-fe67-4eff-88d3-d5f1fca6f51c"
+        body = {
+            "data": {
+            "type": "catalog",
+            "attributes": {
+                "name": "Pizzas catalog",
+                "hierarchy_ids": [
+                    pizzeria_hierarchy_id
+                ],
+                "pricebook_id": PRICE_BOOK_ID,
+                "description": "Pizzeria catalog"
+                }
             }
         }
-    }
-    response = requests.post(endpoint, headers=headers, json=body)
-    response.raise_for_status()
-    return response.json()["data"]["id"]
-
-
-def create_entry(token, flow_slug, fields):
-    endpoint = f"https://api.moltin.com/v2/flows/{flow_slug}/entries"
-    headers = {"Authorization": f"Bearer {token}"}
-
-    entry_fields = {"type": "entry"}
-    for field, value in fields:
-        entry_fields[field] = value
-
-    body = {
-        "data": entry_fields
-     }
-    response = requests.post(endpoint, headers=headers, json=body)
-    response.raise_for_status()
-
-
-def create_flow(token, name, slug, description, is_enabled):
-    endpoint = "https://api.moltin.com/v2/flows"
-    headers = {"Authorization": f"Bearer {token}"}
-    body = {
-        "data": {
-            "type": "flow",
+        response = self.request("POST", "/pcm/catalogs", json=body)
+        return response.json()["data"]["id"]
+
+    def create_entry(self, flow_slug, fields):
+        entry_fields = {"type": "entry"}
+        for field, value in fields:
+            entry_fields[field] = value
+
+        body = {
+            "data": entry_fields
+         }
+        self.request("POST", f"/v2/flows/{flow_slug}/entries", json=body)
+
+    def create_flow(self, name, slug, description, is_enabled):
+        body = {
+            "data": {
+                "type": "flow",
+                "name": name,
+                "slug": slug,
+                "description": description,
+                "enabled": is_enabled
+            }
+         }
+        response = self.request("POST", "/v2/flows", json=body)
+        created_flow_id = response.json()["data"]["id"]
+        return created_flow_id
+
+    def create_flow_field(self, flow_id, name, slug, field_type, description,
+                          is_required, is_enabled):
+        body = {
+          "data": {
+            "type": "field",
             "name": name,
             "slug": slug,
+            "field_type": field_type,
             "description": description,
-            "enabled": is_enabled
-        }
-     }
-    response = requests.post(endpoint, headers=headers, json=body)
-    response.raise_for_status()
-    created_flow_id = response.json()["data"]["id"]
-    return created_flow_id
-
-
-def create_flow_field(token, flow_id, name, slug, field_type, description,
-                      is_required, is_enabled):
-    endpoint = "https://api.moltin.com/v2/fields"
-    headers = {"Authorization": f"Bearer {token}"}
-    body = {
-      "data": {
-        "type": "field",
-        "name": name,
-        "slug": slug,
-        "field_type": field_type,
-        "description": description,
-        "required": is_required,
-        "enabled": is_enabled,
-        "relationships": {
-            "flow": {
-                "data": {
-                    "type": "flow",
-                    "id": flow_id
+            "required": is_required,
+            "enabled": is_enabled,
+            "relationships": {
+                "flow": {
+                    "data": {
+                        "type": "flow",
+                        "id": flow_id
+                    }
                 }
             }
+          }
         }
-      }
-    }
-    response = requests.post(endpoint, headers=headers, json=body)
-    response.raise_for_status()
-    field_id = response.json()["data"]["id"]
-    return field_id
-
-
-def create_product(token, product_name, sku, slug, description):
-    '''Returns product id'''
-    endpoint = "https://api.moltin.com/pcm/products"
-    headers = {
-        "Authorization": f"Bearer {token}",
-        "Content-Type": "application/json"
-    }
-    body = {
-        "data": {
-            "type": "product",
-            "attributes": {
-                "name": product_name,
-                "sku": sku,
-                "slug": slug,
-                "description": description,
-                "commodity_type": "physical",
-                "status": "live",
-            },
+        response = self.request("POST", "/v2/fields", json=body)
+        field_id = response.json()["data"]["id"]
+        return field_id
+
+    def create_product(self, product_name, sku, slug, description):
+        '''Returns product id'''
+        body = {
+            "data": {
+                "type": "product",
+                "attributes": {
+                    "name": product_name,
+                    "sku": sku,
+                    "slug": slug,
+                    "description": description,
+                    "commodity_type": "physical",
+                    "status": "live",
+                },
+            }
         }
-    }
-    response = requests.post(endpoint, headers=headers, json=body)
-    response.raise_for_status()
-    return response.json()["data"]["id"]
-
-
-def delete_product_from_cart(token, cart_id, product_id):
-    endpoint = f"https://api.moltin.com/v2/carts/{cart_id}/items/{product_id}"
-    headers = {"Authorization": f"Bearer {token}"}
-    response = requests.delete(endpoint, headers=headers)
-    response.raise_for_status()
-
-
-def find_product_price(token, product_sku):
-    prices = get_prices(token)
-    for price in prices:
-        if price["attributes"]["sku"] != product_sku:
-            continue
-        return price["attributes"]["currencies"]["RUB"]["amount"]
-
-
-def generate_moltin_token(client_id, secret_key):
-    endpoint = "https://api.moltin.com/oauth/access_token"
-    data = {
-        "client_id": client_id,
-        "client_secret": secret_key,
-        "grant_type": "client_credentials",
-    }
-    response = requests.post(endpoint, data=data)
-    response.raise_for_status()
-    return response.json()["access_token"], response.json()["expires_in"]
-
-
-def get_all_products(token):
-    endpoint = "https://api.moltin.com/pcm/products"
-    headers = {
-        "Authorization": f"Bearer {token}",
-        "Content-Type": "application/json",
-        "EP-Channel": "web store"
-    }
-    response = requests.get(endpoint, headers=headers)
-    response.raise_for_status()
-    return response.json()["data"]
-
-
-def get_cart_items(token, cart_id):
-    endpoint = f"https://api.moltin.com/v2/carts/{cart_id}/items"
-    headers = {
-        "Authorization": f"Bearer {token}",
-        "Content-Type": "application/json",
-    }
-    response = requests.get(endpoint, headers=headers)
-    response.raise_for_status()
-    return response.json()
-
-
-def get_pricebook(token):
-    price_book_id = "902947fd-5c0e-4a86-83b1-d347be42426a"
-    price_params = {"include": "prices"}
-    prices_response = requests.get(
-        f"https://api.moltin.com/pcm/pricebooks/{price_book_id}",
-        headers={"Authorization": f"Bearer {token}"},
-        params=price_params
-    )
-    prices_response.raise_for_status()
-    return prices_response.json()
-
-
-def get_prices(token):
-    price_book_id = "902947fd-5c0e-4a86-83b1-d347be42426a"
-    endpoint = f"https://api.moltin.com/pcm/pricebooks/{price_book_id}/prices"
-    headers = {"Authorization": f"Bearer {token}"}
-    params = {
-        "page[limit]": 50,
-    }
-    response = requests.get(endpoint, headers=headers, params=params)
-    response.raise_for_status()
-    return response.json()["data"]
-
-
-def get_product_data(token, user_query):
-    endpoint = "https://api.moltin.com/pcm/products/{}"
-    headers = {
-        "Authorization": f"Bearer {token}",
-        "Content-Type": "application/json",
-    }
-    response = requests.get(endpoint.format(user_query.data), headers=headers)
-    response.raise_for_status()
-    return response.json()["data"]
-
-
-def relate_img_product(token, product_id, img_id):
-    endpoint = f"https://api.moltin.com/pcm/products/{product_id}/relationships/main_image"
-    headers = {"Authorization": f"Bearer {token}"}
-    body = {
-        "data": {
-            "type": "file",
-            "id": img_id,
+        response = self.request("POST", "/pcm/products", json=body)
+        return response.json()["data"]["id"]
+
+    def delete_product_from_cart(self, cart_id, product_id):
+        self.request("DELETE", f"/v2/carts/{cart_id}/items/{product_id}")
+
+    def download_file(self, file_url):
+        with metrics.timer("moltin_request", "GET file"):
+            response = self.session.get(file_url, timeout=self.timeout)
+            response.raise_for_status()
+        return response.content
+
+    def fetch_price_index(self):
+        '''Returns {sku: {currency: amount}} for the whole pricebook'''
+        price_index = {}
+        for price in self.iter_prices():
+            price_attrs = price["attributes"]
+            price_index[price_attrs["sku"]] = {
+                currency: details["amount"]
+                for currency, details in price_attrs["currencies"].items()
+            }
+        return price_index
+
+    def fetch_products(self):
+        return list(self.iter_products())
+
+    def fetch_pizzerias_index(self):
+        return PizzeriasIndex(self.get_pizzerias_details())
+
+    def find_product(self, product_id):
+        '''Looks the product up in the cached catalog'''
+        for product in self.get_all_products():
+            if product["id"] == product_id:
+                return product
+
+    def find_product_price(self, product_sku, currency="RUB"):
+        product_prices = self.prices_cache.get().get(product_sku, {})
+        return product_prices.get(currency)
+
+    def find_products_prices(self, product_skus, currency="RUB"):
+        price_index = self.prices_cache.get()
+        return {sku: price_index.get(sku, {}).get(currency)
+                for sku in product_skus}
+
+    def get_all_products(self):
+        return self.products_cache.get()
+
+    def get_cart_items(self, cart_id):
+        return self.request("GET", f"/v2/carts/{cart_id}/items").json()
+
+    def get_file(self, file_id):
+        return self.request("GET", f"/v2/files/{file_id}").json()["data"]
+
+    def get_pizzerias_details(self):
+        return list(self.iter_flow_entries("pizzeria"))
+
+    def get_pricebook(self):
+        price_params = {"include": "prices"}
+        response = self.request("GET", f"/pcm/pricebooks/{PRICE_BOOK_ID}",
+                                params=price_params)
+        return response.json()
+
+    def get_product_data(self, product_id):
+        return self.request("GET", f"/pcm/products/{product_id}").json()["data"]
+
+    def invalidate_prices_cache(self):
+        self.prices_cache.invalidate()
+
+    def invalidate_products_cache(self):
+        self.products_cache.invalidate()
+
+    def invalidate_pizzerias_cache(self):
+        self.pizzerias_cache.invalidate()
+
+    def iter_flow_entries(self, flow_slug, page_size=100):
+        return self.iter_pages(f"/v2/flows/{flow_slug}/entries", page_size)
+
+    def iter_pages(self, path, page_size=100, headers=None):
+        '''Yields entries of a list endpoint page by page, following
+        the pagination links until the last page'''
+        params = {"page[limit]": page_size}
+        while path:
+            page = self.request("GET", path, headers=headers,
+                                params=params).json()
+            if not page["data"]:
+                return
+            yield from page["data"]
+            path = (page.get("links") or {}).get("next")
+            params = None
+
+    def iter_prices(self, page_size=100):
+        return self.iter_pages(f"/pcm/pricebooks/{PRICE_BOOK_ID}/prices",
+                               page_size)
+
+    def iter_products(self, page_size=100):
+        return self.iter_pages("/pcm/products", page_size,
+                               headers={"EP-Channel": "web store"})
+
+    def relate_img_product(self, product_id, img_id):
+        body = {
+            "data": {
+                "type": "file",
+                "id": img_id,
+            }
         }
-    }
-    response = requests.post(endpoint, headers=headers, json=body)
-    response.raise_for_status()
+        self.request(
+            "POST", f"/pcm/products/{product_id}/relationships/main_image",
+            json=body
+        )
+
+    def _refresh_token_in_background(self, token):
+        with self._token_lock:
+            if (self._token_refresh_thread
+                    and self._token_refresh_thread.is_alive()):
+                return
+            self._token_refresh_thread = threading.Thread(
+                target=self._safe_refresh_token, args=(token,), daemon=True
+            )
+            self._token_refresh_thread.start()
+
+    def _safe_refresh_token(self, token):
+        try:
+            self.refresh_token(expired_token=token)
+        except requests.exceptions.RequestException as err:
+            logger.warning(f"Не удалось обновить токен Moltin: {err}")
+
+    def _send(self, method, url, token, headers=None, **kwargs):
+        headers = {"Authorization": f"Bearer {token}", **(headers or {})}
+        if self.rate_limiter:
+            self.rate_limiter.acquire()
+        return self.session.request(method, url, headers=headers, **kwargs)
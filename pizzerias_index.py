@@ -0,0 +1,71 @@
+import numpy as np
+from scipy.spatial import cKDTree
+
+
+EARTH_RADIUS_KM = 6371.0088
+
+
+def to_unit_vectors(coors):
+    lat, lon = np.radians(coors).T
+    return np.column_stack((np.cos(lat) * np.cos(lon),
+                            np.cos(lat) * np.sin(lon),
+                            np.sin(lat)))
+
+
+def get_haversine_distances(from_coors, to_coors):
+    from_lat, from_lon = np.radians(from_coors)
+    to_lat, to_lon = np.radians(to_coors).T
+    half_chord = (np.sin((to_lat - from_lat) / 2) ** 2
+                  + np.cos(from_lat) * np.cos(to_lat)
+                  * np.sin((to_lon - from_lon) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(half_chord))
+
+
+class PizzeriasIndex:
+    '''Answers nearest-k and within-radius queries over pizzerias.
+
+    Pizzerias are stored as points on the unit sphere in a k-d tree:
+    the chord between two points grows with the great-circle distance,
+    so the tree gives exact answers in O(log n).
+    '''
+
+    def __init__(self, pizzerias):
+        self.pizzerias = [{"address": pizzeria["address"],
+                           "carrier_id": pizzeria["carrier-id"]}
+                          for pizzeria in pizzerias]
+        self.coors = np.array(
+            [(float(pizzeria["lat"]), float(pizzeria["lon"]))
+             for pizzeria in pizzerias],
+            dtype=float
+        ).reshape(-1, 2)
+        self._tree = cKDTree(to_unit_vectors(self.coors))
+
+    def __len__(self):
+        return len(self.pizzerias)
+
+    def nearest(self, users_coors, k=1):
+        if not self.pizzerias:
+            return []
+        users_coors = np.array(users_coors, dtype=float)
+        k = min(k, len(self.pizzerias))
+        _, found = self._tree.query(to_unit_vectors(users_coors[None])[0], k=k)
+        return self._with_distances(users_coors, np.atleast_1d(found))
+
+    def within_radius(self, users_coors, radius_km):
+        if not self.pizzerias:
+            return []
+        users_coors = np.array(users_coors, dtype=float)
+        chord = 2 * np.sin(min(radius_km / EARTH_RADIUS_KM, np.pi) / 2)
+        found = self._tree.query_ball_point(
+            to_unit_vectors(users_coors[None])[0], r=chord
+        )
+        found_pizzerias = self._with_distances(users_coors,
+                                               np.array(found, dtype=int))
+        return sorted(found_pizzerias,
+                      key=lambda pizzeria: pizzeria["distance_to_user"])
+
+    def _with_distances(self, users_coors, found):
+        distances = get_haversine_distances(users_coors, self.coors[found])
+        return [{**self.pizzerias[pizzeria_num],
+                 "distance_to_user": round(float(distance), 2)}
+                for pizzeria_num, distance in zip(found, distances)]
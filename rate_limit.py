@@ -0,0 +1,55 @@
+import threading
+from time import monotonic, sleep
+
+
+class RateLimiter:
+    '''Token bucket allowing `rate` calls per second in bursts of `burst`'''
+
+    def __init__(self, rate, burst=None):
+        if rate <= 0:
+            raise ValueError(f"Rate must be positive, got {rate}")
+        self.rate = rate
+        self.burst = max(1, burst or rate)
+        self._tokens = self.burst
+        self._updated_at = monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            wait_time = self.try_acquire()
+            if not wait_time:
+                return
+            sleep(wait_time)
+
+    def try_acquire(self):
+        '''Takes a token if there is one. Returns 0 on success, otherwise
+        seconds until the next token'''
+        with self._lock:
+            wait_time = self._get_wait_time()
+            if not wait_time:
+                self._tokens -= 1
+            return wait_time
+
+    def get_wait_time(self):
+        '''Seconds until a token is available, without taking it'''
+        with self._lock:
+            return self._get_wait_time()
+
+    def is_full(self):
+        with self._lock:
+            self._refill()
+            return self._tokens >= self.burst
+
+    def _refill(self):
+        now = monotonic()
+        self._tokens = min(
+            self.burst,
+            self._tokens + (now - self._updated_at) * self.rate
+        )
+        self._updated_at = now
+
+    def _get_wait_time(self):
+        self._refill()
+        if self._tokens >= 1:
+            return 0
+        return (1 - self._tokens) / self.rate
@@ -0,0 +1,166 @@
+import heapq
+import logging
+import threading
+from contextlib import contextmanager
+from enum import IntEnum
+from itertools import count
+from time import monotonic
+
+from telegram import Bot
+from telegram.error import RetryAfter
+
+from rate_limit import RateLimiter
+
+
+logger = logging.getLogger("TGBotLogger")
+
+# Methods that post a new message to a chat. Edits, deletes and chat
+# actions do not count towards the per-chat limit and go out at once
+THROTTLED_ENDPOINTS = frozenset((
+    "sendMessage", "sendPhoto", "sendLocation", "sendInvoice",
+    "sendDocument", "sendMediaGroup", "sendVenue", "sendContact",
+    "copyMessage", "forwardMessage",
+))
+
+_local = threading.local()
+
+
+class Priority(IntEnum):
+    INTERACTIVE = 0
+    CARRIER = 1
+    BACKGROUND = 2
+
+
+@contextmanager
+def send_priority(priority):
+    '''Sends made by this thread inside the block get the priority'''
+    previous_priority = getattr(_local, "priority", Priority.INTERACTIVE)
+    _local.priority = priority
+    try:
+        yield
+    finally:
+        _local.priority = previous_priority
+
+
+def get_send_priority():
+    return getattr(_local, "priority", Priority.INTERACTIVE)
+
+
+class SendScheduler:
+    '''Decides which pending Telegram call may go out next.
+
+    A call waits for a token of the global bucket and of its chat
+    bucket; among waiting calls the one with the higher priority, then
+    the older one, goes first. A chat that got RetryAfter is paused
+    for the requested time.
+    '''
+
+    def __init__(self, global_rate=30, chat_rate=1, chat_burst=3,
+                 max_chats=10_000):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_chats = max_chats
+        self._global_limiter = RateLimiter(global_rate)
+        self._chat_limiters = {}
+        self._paused_until = {}
+        self._queue = []
+        self._tickets_ids = count()
+        self._condition = threading.Condition()
+        self._granter = threading.Thread(target=self._grant_forever,
+                                         daemon=True)
+        self._granter.start()
+
+    def acquire(self, chat_id, priority=Priority.INTERACTIVE):
+        '''Blocks until the call to the chat may be sent'''
+        granted = threading.Event()
+        with self._condition:
+            heapq.heappush(self._queue, (priority, next(self._tickets_ids),
+                                         chat_id, granted))
+            self._condition.notify()
+        granted.wait()
+
+    def pause_chat(self, chat_id, seconds):
+        with self._condition:
+            self._paused_until[chat_id] = max(
+                self._paused_until.get(chat_id, 0), monotonic() + seconds
+            )
+
+    def _grant_forever(self):
+        with self._condition:
+            while True:
+                wait_time = self._grant_next()
+                if wait_time != 0:
+                    self._condition.wait(wait_time)
+
+    def _grant_next(self):
+        '''Grants one call. Returns 0 after granting, otherwise seconds
+        to wait (None while the queue is empty)'''
+        if not self._queue:
+            return None
+        wait_time = self._global_limiter.get_wait_time()
+        if wait_time:
+            return wait_time
+
+        now = monotonic()
+        for ticket in sorted(self._queue):
+            _, _, chat_id, granted = ticket
+            paused_for = self._paused_until.get(chat_id, 0) - now
+            if paused_for > 0:
+                wait_time = min(wait_time or paused_for, paused_for)
+                continue
+            self._paused_until.pop(chat_id, None)
+            chat_wait_time = self._get_chat_limiter(chat_id).try_acquire()
+            if chat_wait_time:
+                wait_time = min(wait_time or chat_wait_time, chat_wait_time)
+                continue
+            self._global_limiter.try_acquire()
+            self._queue.remove(ticket)
+            heapq.heapify(self._queue)
+            granted.set()
+            return 0
+        return wait_time
+
+    def _get_chat_limiter(self, chat_id):
+        chat_limiter = self._chat_limiters.get(chat_id)
+        if chat_limiter:
+            return chat_limiter
+        if len(self._chat_limiters) >= self.max_chats:
+            self._chat_limiters = {
+                chat_id: chat_limiter
+                for chat_id, chat_limiter in self._chat_limiters.items()
+                if not chat_limiter.is_full()
+            }
+        chat_limiter = RateLimiter(self.chat_rate, self.chat_burst)
+        self._chat_limiters[chat_id] = chat_limiter
+        return chat_limiter
+
+
+class ScheduledBot(Bot):
+    '''Bot whose new messages to chats go through a SendScheduler.
+
+    Other calls (edits, deletes, answerCallbackQuery, getUpdates and the
+    like) are sent at once. A message answered with RetryAfter is
+    repeated after the pause up to max_retries times.
+    '''
+
+    def __init__(self, token, scheduler, max_retries=3, **kwargs):
+        super().__init__(token, **kwargs)
+        self.scheduler = scheduler
+        self.max_retries = max_retries
+
+    def _post(self, endpoint, data=None, *args, **kwargs):
+        chat_id = (data or {}).get("chat_id")
+        if chat_id is None or endpoint not in THROTTLED_ENDPOINTS:
+            return super()._post(endpoint, data, *args, **kwargs)
+
+        priority = get_send_priority()
+        for attempt in range(self.max_retries + 1):
+            self.scheduler.acquire(chat_id, priority)
+            try:
+                return super()._post(endpoint, dict(data), *args, **kwargs)
+            except RetryAfter as err:
+                if attempt == self.max_retries:
+                    raise
+                logger.warning(f"Telegram просит подождать {err.retry_after} с "
+                               f"перед {endpoint} в чат {chat_id}")
+                self.scheduler.pause_chat(chat_id, err.retry_after)
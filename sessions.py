@@ -0,0 +1,84 @@
+import sys
+from time import time
+
+
+class CheckoutSession:
+    '''Per-user state of the order flow kept in user_data["session"]'''
+
+    __slots__ = ("current_page", "total", "delivery_price", "delivery_method",
+                 "customer_coors", "pizzeria_address", "carrier_id",
+                 "last_seen")
+
+    def __init__(self):
+        self.current_page = 0
+        self.total = 0
+        self.delivery_price = 0
+        self.delivery_method = None
+        self.customer_coors = None
+        self.pizzeria_address = None
+        self.carrier_id = None
+        self.last_seen = time()
+
+    def __getstate__(self):
+        return {slot: getattr(self, slot) for slot in self.__slots__
+                if slot != "last_seen"}
+
+    def __setstate__(self, state):
+        self.__init__()
+        for slot, value in state.items():
+            setattr(self, slot, value)
+
+
+def get_session(context):
+    session = context.user_data.get("session")
+    if session is None:
+        session = context.user_data["session"] = CheckoutSession()
+    session.last_seen = time()
+    return session
+
+
+def evict_idle_sessions(context):
+    '''Drops user_data and local carts of users idle for longer than job
+    context seconds. Their data stays in persistence and Moltin and is
+    loaded again on next visit'''
+    idle_timeout = context.job.context
+    dispatcher = context.dispatcher
+    cart_mirror = dispatcher.bot_data.get("cart_mirror")
+    now = time()
+    for user_id, user_data in list(dispatcher.user_data.items()):
+        session = user_data.get("session")
+        if session and now - session.last_seen < idle_timeout:
+            continue
+        dispatcher.user_data.pop(user_id, None)
+        if dispatcher.persistence:
+            dispatcher.persistence.forget("user", user_id)
+        if cart_mirror:
+            cart_mirror.forget(user_id)
+
+
+def get_deep_size(obj, seen=None):
+    seen = seen if seen is not None else set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(get_deep_size(key, seen) + get_deep_size(value, seen)
+                    for key, value in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(get_deep_size(item, seen) for item in obj)
+    elif hasattr(obj, "__slots__"):
+        size += sum(get_deep_size(getattr(obj, slot), seen)
+                    for slot in obj.__slots__ if hasattr(obj, slot))
+    return size
+
+
+def get_memory_report(dispatcher, conversation_handlers):
+    user_data = dict(dispatcher.user_data)
+    sessions_num = sum(1 for data in user_data.values() if "session" in data)
+    conversations_num = sum(len(handler.conversations)
+                            for handler in conversation_handlers)
+    return (f"Сессий в памяти: {sessions_num}\n"
+            f"Записей user_data: {len(user_data)}, "
+            f"{get_deep_size(user_data) / 1024:.1f} КБ\n"
+            f"Активных диалогов: {conversations_num}")
@@ -0,0 +1,232 @@
+import json
+import logging
+import pickle
+import sqlite3
+import threading
+from collections import defaultdict
+
+from telegram.ext import BasePersistence, ConversationHandler
+from telegram.ext.utils.promise import Promise
+
+
+logger = logging.getLogger("TGBotLogger")
+
+class LazyDataDict(defaultdict):
+    '''user_data / chat_data that loads an entry on first access'''
+
+    def __init__(self, loader, *args):
+        super().__init__(dict, *args)
+        self.loader = loader
+
+    def __missing__(self, key):
+        value = self.loader(key)
+        self[key] = value
+        return value
+
+    def __copy__(self):
+        return type(self)(self.loader, self)
+
+    copy = __copy__
+
+
+class LazyConversations(dict):
+    '''Conversation states that are loaded per key on lookup.
+
+    Only active conversations are kept in memory; keys without a stored
+    state cost one primary-key lookup in SQLite.
+    '''
+
+    def __init__(self, loader):
+        super().__init__()
+        self.loader = loader
+
+    def _load(self, key):
+        if dict.__contains__(self, key):
+            return
+        state = self.loader(key)
+        if state is not None:
+            self[key] = state
+
+    def get(self, key, default=None):
+        self._load(key)
+        return super().get(key, default)
+
+    def __contains__(self, key):
+        self._load(key)
+        return super().__contains__(key)
+
+
+class SQLitePersistence(BasePersistence):
+    '''Stores conversations, user_data, chat_data and bot_data in SQLite.
+
+    Nothing is read at startup: entries are loaded when a user first
+    shows up. Updates are pickled in place and written by a background
+    thread in one transaction every flush_interval seconds; unchanged
+    entries are not written at all. close() writes what is left and
+    stops the thread.
+
+    A conversation step run with run_async is written once its promise
+    has settled, with the state the handler returned.
+    '''
+
+    def __init__(self, path, flush_interval=5, store_user_data=True,
+                 store_chat_data=True, store_bot_data=True):
+        super().__init__(store_user_data=store_user_data,
+                         store_chat_data=store_chat_data,
+                         store_bot_data=store_bot_data)
+        self.path = path
+        self.flush_interval = flush_interval
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db_lock = threading.Lock()
+        with self._db_lock, self._db:
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS persistence ("
+                "kind TEXT NOT NULL, key TEXT NOT NULL, value BLOB, "
+                "PRIMARY KEY (kind, key))"
+            )
+        self._pending = {}
+        self._writing = {}
+        self._written_hashes = {}
+        self._pending_promises = {}
+        self._pending_lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._writer = threading.Thread(target=self._write_periodically,
+                                        daemon=True)
+        self._writer.start()
+
+    def get_user_data(self):
+        return LazyDataDict(lambda user_id: self._load("user", user_id, {}))
+
+    def get_chat_data(self):
+        return LazyDataDict(lambda chat_id: self._load("chat", chat_id, {}))
+
+    def get_bot_data(self):
+        return self._load("bot", "", {})
+
+    def get_conversations(self, name):
+        return LazyConversations(
+            lambda key: self._load(f"conversation:{name}", json.dumps(key))
+        )
+
+    def update_user_data(self, user_id, data):
+        self._stage("user", user_id, data)
+
+    def update_chat_data(self, chat_id, data):
+        self._stage("chat", chat_id, data)
+
+    def update_bot_data(self, data):
+        self._stage("bot", "", data)
+
+    def update_conversation(self, name, key, new_state):
+        kind, key = f"conversation:{name}", json.dumps(key)
+        promise = None
+        # a handler run with run_async leaves (old_state, promise), and
+        # ConversationHandler wraps that pair once more
+        while isinstance(new_state, tuple) and isinstance(new_state[-1],
+                                                           Promise):
+            new_state, promise = new_state
+        with self._pending_lock:
+            if promise:
+                self._pending_promises[(kind, key)] = (new_state, promise)
+                return
+            self._pending_promises.pop((kind, key), None)
+        self._stage(kind, key, new_state)
+
+    def forget(self, kind, key):
+        '''Drops in-memory bookkeeping of an entry evicted from memory'''
+        with self._pending_lock:
+            self._written_hashes.pop((kind, str(key)), None)
+
+    def flush(self):
+        '''Writes pending entries now; the writer thread keeps running,
+        so entries staged afterwards are written too'''
+        self._write_pending()
+
+    def close(self):
+        self._stop_event.set()
+        self._writer.join()
+        self._write_pending()
+
+    def _load(self, kind, key, default=None):
+        key = str(key)
+        with self._pending_lock:
+            for unsaved in (self._pending, self._writing):
+                if (kind, key) in unsaved:
+                    value = unsaved[(kind, key)]
+                    return pickle.loads(value) if value is not None else default
+        with self._db_lock:
+            stored = self._db.execute(
+                "SELECT value FROM persistence WHERE kind = ? AND key = ?",
+                (kind, key)
+            ).fetchone()
+        if not stored or stored[0] is None:
+            return default
+        return pickle.loads(stored[0])
+
+    def _stage(self, kind, key, data):
+        key = str(key)
+        value = pickle.dumps(data) if data is not None else None
+        value_hash = hash(value)
+        with self._pending_lock:
+            if self._written_hashes.get((kind, key)) == value_hash:
+                return
+            self._written_hashes[(kind, key)] = value_hash
+            self._pending[(kind, key)] = value
+
+    def _stage_settled_promises(self):
+        with self._pending_lock:
+            settled = [(kind_key, old_state, promise)
+                       for kind_key, (old_state, promise)
+                       in self._pending_promises.items()
+                       if promise.done.is_set()]
+            for kind_key, _, _ in settled:
+                del self._pending_promises[kind_key]
+        for (kind, key), old_state, promise in settled:
+            new_state = promise.result(0) if not promise.exception else None
+            if new_state is None:
+                new_state = old_state
+            if new_state == ConversationHandler.END:
+                new_state = None
+            self._stage(kind, key, new_state)
+
+    def _write_periodically(self):
+        while not self._stop_event.wait(self.flush_interval):
+            try:
+                self._write_pending()
+            except sqlite3.Error as err:
+                logger.error(f"Не удалось сохранить состояние бота: {err}")
+
+    def _write_pending(self):
+        self._stage_settled_promises()
+        with self._write_lock:
+            with self._pending_lock:
+                pending, self._pending = self._pending, {}
+                self._writing = pending
+            if not pending:
+                return
+            try:
+                self._write_to_db(pending)
+            except sqlite3.Error:
+                # keep failed entries unless they were staged again meanwhile
+                with self._pending_lock:
+                    self._pending = {**pending, **self._pending}
+                raise
+            finally:
+                with self._pending_lock:
+                    self._writing = {}
+
+    def _write_to_db(self, pending):
+        upserts = [(kind, key, value)
+                   for (kind, key), value in pending.items()
+                   if value is not None]
+        deletes = [(kind, key)
+                   for (kind, key), value in pending.items()
+                   if value is None]
+        with self._db_lock, self._db:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO persistence VALUES (?, ?, ?)", upserts
+            )
+            self._db.executemany(
+                "DELETE FROM persistence WHERE kind = ? AND key = ?", deletes
+            )
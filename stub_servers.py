@@ -0,0 +1,306 @@
+import json
+import random
+import re
+import threading
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import count
+from time import sleep, time
+from urllib.parse import parse_qs, urlsplit
+
+
+# 1x1 transparent PNG served as every product photo
+PNG_PIXEL = bytes.fromhex(
+    "89504e470d0a1a0a0000000d4948445200000001000000010806000000"
+    "1f15c4890000000d49444154789c6360000002000001e221bc330000000049454e44ae426082"
+)
+
+
+def make_products(products_num):
+    '''Products the way /pcm/products lists them'''
+    return [
+        {
+            "id": str(uuid.uuid5(uuid.NAMESPACE_URL, f"product-{num}")),
+            "type": "product",
+            "attributes": {
+                "name": f"Пицца №{num}",
+                "sku": f"sku-{num}",
+                "description": "Тесто, томатный соус, сыр.",
+            },
+            "relationships": {
+                "main_image": {"data": {
+                    "type": "file",
+                    "id": str(uuid.uuid5(uuid.NAMESPACE_URL, f"image-{num}")),
+                }},
+            },
+        }
+        for num in range(products_num)
+    ]
+
+
+def make_prices(products):
+    '''Pricebook prices of the products'''
+    return [
+        {
+            "type": "product-price",
+            "attributes": {
+                "sku": product["attributes"]["sku"],
+                "currencies": {"RUB": {"amount": 100 + num * 10,
+                                       "includes_tax": True}},
+            },
+        }
+        for num, product in enumerate(products)
+    ]
+
+
+def make_pizzerias(pizzerias_num, seed=0):
+    '''Entries of the pizzeria flow scattered over Moscow'''
+    coors_random = random.Random(seed)
+    return [
+        {
+            "id": f"pizzeria-{num}",
+            "address": f"Пиццерия №{num}",
+            "alias": f"pizzeria-{num}",
+            "lat": 55.55 + coors_random.random() * 0.4,
+            "lon": 37.35 + coors_random.random() * 0.5,
+            "carrier-id": 1000 + num,
+        }
+        for num in range(pizzerias_num)
+    ]
+
+
+class StubServer:
+    '''Local HTTP server that answers like a remote API.
+
+    Every request is delayed by latency ± jitter seconds and answered
+    with error_status with probability error_rate. Subclasses implement
+    route(method, path, query, body) returning (status, payload).
+    '''
+
+    error_status = 500
+
+    def __init__(self, latency=0, jitter=0, error_rate=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.requests_num = 0
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0),
+                                           self._make_request_handler())
+        self._server.daemon_threads = True
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self._server.server_port}"
+
+    def start(self):
+        threading.Thread(target=self._server.serve_forever,
+                         daemon=True).start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def route(self, method, path, query, body):
+        raise NotImplementedError
+
+    def _make_request_handler(self):
+        stub = self
+
+        class RequestHandler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                self._answer("GET")
+
+            def do_POST(self):
+                self._answer("POST")
+
+            def do_DELETE(self):
+                self._answer("DELETE")
+
+            def _answer(self, method):
+                body_size = int(self.headers.get("Content-Length") or 0)
+                body = self.rfile.read(body_size) if body_size else b""
+                split_url = urlsplit(self.path)
+                with stub._lock:
+                    stub.requests_num += 1
+                delay = stub.latency + random.uniform(-stub.jitter,
+                                                      stub.jitter)
+                if delay > 0:
+                    sleep(delay)
+                if random.random() < stub.error_rate:
+                    status, payload = stub.error_status, {"error": "injected"}
+                else:
+                    status, payload = stub.route(
+                        method, split_url.path, parse_qs(split_url.query),
+                        stub.parse_body(self.headers, body)
+                    )
+                if isinstance(payload, bytes):
+                    content, content_type = payload, "image/png"
+                else:
+                    content = json.dumps(payload).encode()
+                    content_type = "application/json"
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, format, *args):
+                pass
+
+        return RequestHandler
+
+    @staticmethod
+    def parse_body(headers, body):
+        if headers.get("Content-Type", "").startswith("application/json"):
+            return json.loads(body or b"{}")
+        return {}
+
+
+class MoltinStub(StubServer):
+    '''Catalog, pricebook, files, carts and flows of a Moltin store'''
+
+    def __init__(self, products_num=50, pizzerias_num=100, **kwargs):
+        super().__init__(**kwargs)
+        self.products = {product["id"]: product
+                         for product in make_products(products_num)}
+        self.prices = make_prices(self.products.values())
+        self.pizzerias = make_pizzerias(pizzerias_num)
+        self.carts = {}
+        self._item_ids = count()
+        self._carts_lock = threading.Lock()
+
+    def route(self, method, path, query, body):
+        if path == "/oauth/access_token":
+            return 200, {"access_token": "stub-token", "expires_in": 3600}
+        if path == "/pcm/products":
+            return 200, self._paginate(path, query,
+                                       list(self.products.values()))
+        if re.fullmatch(r"/pcm/pricebooks/[^/]+/prices", path):
+            return 200, self._paginate(path, query, self.prices)
+        if path == "/v2/flows/pizzeria/entries":
+            return 200, self._paginate(path, query, self.pizzerias)
+        if re.fullmatch(r"/v2/flows/[^/]+/entries", path):
+            return 201, {"data": {"id": "entry", **body.get("data", {})}}
+
+        product_match = re.fullmatch(r"/pcm/products/([^/]+)", path)
+        if product_match:
+            product = self.products.get(product_match.group(1))
+            return (200, {"data": product}) if product else (404, {})
+
+        file_match = re.fullmatch(r"/v2/files/([^/]+)", path)
+        if file_match:
+            file_url = f"{self.base_url}/raw/{file_match.group(1)}.png"
+            return 200, {"data": {"id": file_match.group(1),
+                                  "link": {"href": file_url}}}
+        if path.startswith("/raw/"):
+            return 200, PNG_PIXEL
+
+        cart_match = re.fullmatch(r"/v2/carts/([^/]+)/items(?:/([^/]+))?",
+                                  path)
+        if cart_match:
+            return self._route_cart(method, *cart_match.groups(), body)
+        return 404, {"errors": [{"detail": f"{method} {path}"}]}
+
+    def _paginate(self, path, query, entries):
+        limit = int(query.get("page[limit]", ["100"])[0])
+        offset = int(query.get("page[offset]", ["0"])[0])
+        page = {"data": entries[offset:offset + limit], "links": {}}
+        if offset + limit < len(entries):
+            page["links"]["next"] = (f"{self.base_url}{path}?page[limit]="
+                                     f"{limit}&page[offset]={offset + limit}")
+        return page
+
+    def _route_cart(self, method, cart_id, item_id, body):
+        with self._carts_lock:
+            cart = self.carts.setdefault(cart_id, {})
+            if method == "POST":
+                product_id = body["data"]["id"]
+                product = self.products[product_id]
+                if product_id not in cart:
+                    cart[product_id] = {
+                        "id": f"item-{next(self._item_ids)}",
+                        "product_id": product_id,
+                        "name": product["attributes"]["name"],
+                        "quantity": 0,
+                    }
+                cart[product_id]["quantity"] += body["data"]["quantity"]
+            elif method == "DELETE":
+                for product_id, item in list(cart.items()):
+                    if item["id"] == item_id:
+                        del cart[product_id]
+            items = [self._make_cart_item(item) for item in cart.values()]
+        return 200, {"data": items}
+
+    def _make_cart_item(self, item):
+        sku = self.products[item["product_id"]]["attributes"]["sku"]
+        unit_price = next(
+            price["attributes"]["currencies"]["RUB"]["amount"]
+            for price in self.prices if price["attributes"]["sku"] == sku
+        )
+        return {
+            **item,
+            "meta": {"display_price": {"with_tax": {
+                "unit": {"amount": unit_price},
+                "value": {"amount": unit_price * item["quantity"]},
+            }}},
+        }
+
+
+class TelegramStub(StubServer):
+    '''Bot API methods used by the bot; every call succeeds'''
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._message_ids = count(1)
+
+    @staticmethod
+    def parse_body(headers, body):
+        if headers.get("Content-Type", "").startswith("application/json"):
+            return json.loads(body or b"{}")
+        chat_id = re.search(rb'name="chat_id"\r\n\r\n(-?\d+)', body)
+        return {"chat_id": int(chat_id.group(1)) if chat_id else 0}
+
+    def route(self, method, path, query, body):
+        bot_method = path.rsplit("/", 1)[-1]
+        if bot_method == "getMe":
+            return 200, {"ok": True, "result": {
+                "id": 1, "is_bot": True, "first_name": "Stub",
+                "username": "stub_bot",
+            }}
+        if bot_method in ("deleteMessage", "answerCallbackQuery",
+                          "answerPreCheckoutQuery"):
+            return 200, {"ok": True, "result": True}
+
+        message = {
+            "message_id": next(self._message_ids),
+            "date": int(time()),
+            "chat": {"id": int(body.get("chat_id") or 0), "type": "private"},
+        }
+        if bot_method in ("sendPhoto", "editMessageMedia"):
+            message["photo"] = [{"file_id": f"photo-{message['message_id']}",
+                                 "file_unique_id": "photo",
+                                 "width": 1, "height": 1}]
+            message["caption"] = body.get("caption", "")
+        elif bot_method == "sendLocation":
+            message["location"] = {"latitude": body.get("latitude", 0),
+                                   "longitude": body.get("longitude", 0)}
+        else:
+            message["text"] = body.get("text", "")
+        return 200, {"ok": True, "result": message}
+
+
+class YandexGeocoderStub(StubServer):
+    '''Geocoder that places every address somewhere in Moscow'''
+
+    def route(self, method, path, query, body):
+        address = query.get("geocode", [""])[0]
+        address_random = random.Random(address)
+        lat = 55.55 + address_random.random() * 0.4
+        lon = 37.35 + address_random.random() * 0.5
+        return 200, {"response": {"GeoObjectCollection": {"featureMember": [
+            {"GeoObject": {"Point": {"pos": f"{lon} {lat}"}}},
+        ]}}}
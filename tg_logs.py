@@ -0,0 +1,116 @@
+import logging
+import threading
+from collections import deque
+from time import monotonic, sleep
+
+from telegram.error import RetryAfter, TelegramError
+
+
+TG_MESSAGE_MAX_LENGTH = 4096
+
+
+class TelegramLogsHandler(logging.Handler):
+    '''Ships log records to a Telegram chat without blocking the caller.
+
+    emit() only puts the record into a bounded queue. A background thread
+    sends queued records every flush_interval seconds as combined
+    messages, collapsing repeated records and sending no more than one
+    message per min_send_interval seconds. When the queue is full, the
+    least severe record is dropped.
+    '''
+
+    def __init__(self, tg_bot, chat_id, queue_size=1000, flush_interval=2,
+                 min_send_interval=1):
+        super().__init__()
+        self.chat_id = chat_id
+        self.tg_bot = tg_bot
+        self.queue_size = queue_size
+        self.flush_interval = flush_interval
+        self.min_send_interval = min_send_interval
+        self._records = deque()
+        self._dropped_num = 0
+        self._last_sent_at = 0
+        self._condition = threading.Condition()
+        self._is_closed = False
+        self._shipper = threading.Thread(target=self._ship_periodically,
+                                         daemon=True)
+        self._shipper.start()
+
+    def emit(self, record):
+        try:
+            log_entry = (record.levelno, record.getMessage(), self.format(record))
+        except Exception:
+            self.handleError(record)
+            return
+        with self._condition:
+            if len(self._records) >= self.queue_size:
+                least_severe = min(self._records, key=lambda entry: entry[0])
+                if least_severe[0] > record.levelno:
+                    self._dropped_num += 1
+                    return
+                self._records.remove(least_severe)
+                self._dropped_num += 1
+            self._records.append(log_entry)
+
+    def close(self):
+        with self._condition:
+            self._is_closed = True
+            self._condition.notify()
+        self._shipper.join(timeout=10)
+        super().close()
+
+    def _ship_periodically(self):
+        while True:
+            with self._condition:
+                if not self._is_closed:
+                    self._condition.wait(self.flush_interval)
+                is_closed = self._is_closed
+                records, self._records = list(self._records), deque()
+                dropped_num, self._dropped_num = self._dropped_num, 0
+            for text in self._make_messages(records, dropped_num):
+                self._send(text)
+            if is_closed:
+                return
+
+    def _make_messages(self, records, dropped_num):
+        collapsed = {}
+        for levelno, message, log_entry in records:
+            key = (levelno, message)
+            if key in collapsed:
+                collapsed[key][1] += 1
+            else:
+                collapsed[key] = [log_entry, 1]
+
+        entries = [log_entry if repeats == 1
+                   else f"{log_entry}\n(повторилось {repeats} раз)"
+                   for log_entry, repeats in collapsed.values()]
+        if dropped_num:
+            entries.append(f"⚠ Пропущено записей лога: {dropped_num}")
+
+        messages = []
+        message = ""
+        for entry in entries:
+            entry = entry[:TG_MESSAGE_MAX_LENGTH]
+            if message and len(message) + len(entry) + 2 > TG_MESSAGE_MAX_LENGTH:
+                messages.append(message)
+                message = ""
+            message = f"{message}\n\n{entry}" if message else entry
+        if message:
+            messages.append(message)
+        return messages
+
+    def _send(self, text):
+        wait_time = self._last_sent_at + self.min_send_interval - monotonic()
+        if wait_time > 0:
+            sleep(wait_time)
+        try:
+            self.tg_bot.send_message(chat_id=self.chat_id, text=text)
+        except RetryAfter as err:
+            sleep(err.retry_after)
+            try:
+                self.tg_bot.send_message(chat_id=self.chat_id, text=text)
+            except TelegramError:
+                pass
+        except TelegramError:
+            pass
+        self._last_sent_at = monotonic()
@@ -1,17 +1,20 @@
 import argparse
+import hashlib
 import json
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import partial
+from time import monotonic
 
 import requests
 from environs import Env
 from slugify import slugify
 
-from moltin_handlers import (add_img,
-                             add_product_price,
-                             create_entry,
-                             create_flow_field,
-                             create_product,
-                             generate_moltin_token,
-                             relate_img_product)
+from import_journal import ImportJournal
+from moltin_handlers import MoltinClient
+from rate_limit import RateLimiter
+
+
+PRODUCT_IMPORT_STEPS = ("create", "price", "image", "relation")
 
 
 def get_args():
@@ -30,6 +33,22 @@ def get_args():
                         action="store_true",
                         help="Load pizzerias addresses to Moltin from "
                              "address.json file")
+    parser.add_argument("-w", "--workers",
+                        type=int,
+                        default=8,
+                        help="Number of parallel import workers")
+    parser.add_argument("-r", "--rate",
+                        type=float,
+                        default=10,
+                        help="Max Moltin requests per second")
+    parser.add_argument("-j", "--journal",
+                        default="import_journal.jsonl",
+                        help="Journal of finished import steps, used to "
+                             "resume an interrupted import")
+    parser.add_argument("--hash_images",
+                        action="store_true",
+                        help="Deduplicate images by content hash instead "
+                             "of URL")
     return parser.parse_args()
 
 
@@ -39,32 +58,134 @@ def read_json(filename):
     return file_data
 
 
-def load_products(token, menu):
-    params = {"page[limit]": 100}
-    products_response = requests.get(
-        "https://api.moltin.com/pcm/products",
-        headers={"Authorization": f"Bearer {token}"},
-        params=params
-    )
-    products_response.raise_for_status()
-    existing_products = products_response.json()["data"]
-    product_skus = [product["attributes"]["sku"] for product in existing_products]
+def get_existing_skus(moltin_client):
+    return {product["attributes"]["sku"]
+            for product in moltin_client.iter_products()}
 
-    for product in menu:
-        product_name = product["name"]
-        product_id = str(product["id"])
-        if product_id in product_skus:
-            continue
+
+def get_image_key(moltin_client, img_url, hash_images):
+    if not hash_images:
+        return img_url
+    img_content = moltin_client.download_file(img_url)
+    return f"sha256:{hashlib.sha256(img_content).hexdigest()}"
+
+
+def import_product(moltin_client, journal, product, hash_images=False):
+    product_name = product["name"]
+    product_id = str(product["id"])
+    done_steps = journal.get_steps(product_id)
+
+    created_product_id = done_steps.get("create")
+    if not created_product_id:
         slug = slugify(f"{product_id} {product_name}", to_lower=True)
-        product_description = product["description"]
-        product_price = product["price"]
-        img_url = product["product_image"]["url"]
+        created_product_id = moltin_client.create_product(
+            product_name, product_id, slug, product["description"]
+        )
+        journal.record(product_id, "create", created_product_id)
+
+    if not done_steps.get("price"):
+        moltin_client.add_product_price(product_id, product["price"])
+        journal.record(product_id, "price")
 
-        created_product_id = create_product(token, product_name, product_id,
-                                            slug, product_description)
-        add_product_price(token, product_id, product_price)
-        img_id = add_img(token, img_url)
-        relate_img_product(token, created_product_id, img_id)
+    img_id = done_steps.get("image")
+    if not img_id:
+        img_url = product["product_image"]["url"]
+        img_id = journal.get_or_add_image(
+            get_image_key(moltin_client, img_url, hash_images),
+            partial(moltin_client.add_img, img_url)
+        )
+        journal.record(product_id, "image", img_id)
+
+    if not done_steps.get("relation"):
+        moltin_client.relate_img_product(created_product_id, img_id)
+        journal.record(product_id, "relation")
+
+
+def import_address(moltin_client, address):
+    pizzeria_flow_slug = "pizzeria"
+    address_details = address["address"]["full"]
+    alias = address["alias"]
+    lat = address["coordinates"]["lat"]
+    lon = address["coordinates"]["lon"]
+    carrier_tg_id = 0
+    fields = [
+        ("address", address_details),
+        ("alias", alias),
+        ("lat", lat),
+        ("lon", lon),
+        ("carrier-id", carrier_tg_id)
+    ]
+    moltin_client.create_entry(pizzeria_flow_slug, fields)
+
+
+def run_import(title, pipeline, items, workers):
+    '''Runs pipeline for every {label: item} on a pool of workers and
+    prints throughput and failures. Returns {label: error}'''
+    started_at = monotonic()
+    failures = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(pipeline, item): label
+                   for label, item in items.items()}
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as err:
+                failures[futures[future]] = err
+    elapsed = monotonic() - started_at
+
+    imported_num = len(items) - len(failures)
+    print(f"{title}: загружено {imported_num} из {len(items)} "
+          f"за {elapsed:.1f} с ({imported_num / max(elapsed, 1e-6):.1f} в секунду)")
+    for label, err in failures.items():
+        print(f"  ✖ {label}: {err}")
+    return failures
+
+
+def request_catalog_reload(reload_url):
+    '''Asks the running bot to read the catalog from Moltin again'''
+    try:
+        response = requests.post(reload_url, timeout=60)
+        response.raise_for_status()
+    except requests.exceptions.RequestException as err:
+        print(f"Бот не перечитал каталог ({err}). Отправьте /reload_catalog "
+              f"в чат администратора")
+        return
+    print(f"Бот перечитал каталог, товаров: {response.text}")
+
+
+def load_products(moltin_client, menu, journal, workers=8,
+                  hash_images=False, reload_url=None):
+    product_skus = get_existing_skus(moltin_client)
+    pending_products = {}
+    for product in menu:
+        sku = str(product["id"])
+        if sku in journal:
+            if len(journal.get_steps(sku)) == len(PRODUCT_IMPORT_STEPS):
+                continue
+        elif sku in product_skus:
+            continue
+        pending_products[sku] = product
+    failures = run_import("Товары",
+                          partial(import_product, moltin_client, journal,
+                                  hash_images=hash_images),
+                          pending_products,
+                          workers)
+    if pending_products and reload_url:
+        request_catalog_reload(reload_url)
+    return failures
+
+
+def load_addresses(moltin_client, addresses, workers=8, reload_url=None):
+    failures = run_import("Адреса",
+                          partial(import_address, moltin_client),
+                          # aliases may repeat, so the position keeps
+                          # every address
+                          {f"#{num} {address['alias']}": address
+                           for num, address in enumerate(addresses, start=1)},
+                          workers)
+    if addresses and reload_url:
+        request_catalog_reload(reload_url)
+    return failures
 
 
 def main():
@@ -74,40 +195,32 @@ def main():
 
     moltin_client_id = env.str("MOLTIN_CLIENT_ID")
     moltin_secret_key = env.str("MOLTIN_SECRET_KEY")
+    metrics_port = env.int("METRICS_PORT", 8097)
+    reload_url = f"http://127.0.0.1:{metrics_port}/reload_catalog"
 
     addresses = read_json("addresses.json")
     menu = read_json("menu.json")
-    moltin_token, exp_period = generate_moltin_token(moltin_client_id,
-                                                     moltin_secret_key)
+    moltin_client = MoltinClient(moltin_client_id,
+                                 moltin_secret_key,
+                                 pool_size=args.workers,
+                                 rate_limiter=RateLimiter(args.rate))
+    moltin_client.get_token()
     if args.load_products:
-        load_products(moltin_token, menu)
+        journal = ImportJournal(args.journal)
+        load_products(moltin_client, menu, journal, args.workers,
+                      args.hash_images, reload_url)
 
     if args.load_addresses:
-        pizzeria_flow_slug = "pizzeria"
-        for address in addresses:
-            address_details = address["address"]["full"]
-            alias = address["alias"]
-            lat = address["coordinates"]["lat"]
-            lon = address["coordinates"]["lon"]
-            carrier_tg_id = 0
-            fields = [
-                ("address", address_details),
-                ("alias", alias),
-                ("lat", lat),
-                ("lon", lon),
-                ("carrier-id", carrier_tg_id)
-            ]
-            create_entry(moltin_token, pizzeria_flow_slug, fields)
+        load_addresses(moltin_client, addresses, args.workers, reload_url)
 
     if args.create_field:
         flow_id, field_name, field_slug, field_type, field_description = args.create_field
-        create_flow_field(moltin_token,
-                          flow_id,
-                          field_name,
-                          field_slug,
-                          field_type,
-                          field_description,
-                          True, True)
+        moltin_client.create_flow_field(flow_id,
+                                        field_name,
+                                        field_slug,
+                                        field_type,
+                                        field_description,
+                                        True, True)
 
 
 if __name__ == "__main__":